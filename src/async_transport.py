@@ -0,0 +1,235 @@
+import logging
+import asyncio
+import itertools
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+
+log = logging.getLogger(__name__)
+
+# Frame: payload length, request id (0 for messages that expect no response), payload
+FRAME_HEADER = struct.Struct(">II")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+CONNECT_TIMEOUT = 5
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+MAX_QUEUED_FRAMES = 1024  # Frames waiting for a peer that is down, newer frames are dropped beyond this
+MAX_CONCURRENT_HANDLERS = 256  # Messages being handled at once, reading from peers pauses beyond this
+HANDLER_WORKERS = 16  # Threads running the (blocking) message handlers
+
+
+def pack_frame(req_id, payload):
+    return FRAME_HEADER.pack(len(payload), req_id) + payload
+
+
+async def read_frame(reader):
+    """Returns (request id, payload)."""
+    size, req_id = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {size} bytes is too big")
+    return req_id, await reader.readexactly(size)
+
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+
+class AsyncPeer:
+    """
+    Outbound connection to one peer, owned by the event loop. Frames are written from a queue,
+    the connection is reopened with exponential backoff and responses are matched by request id.
+    """
+    def __init__(self, transport, addr):
+        self.transport = transport
+        self.addr = addr
+        self.frames = asyncio.Queue(MAX_QUEUED_FRAMES)
+        self.pending = {}  # request id -> concurrent Future
+        self.ids = itertools.count(1)
+        self.writer = None
+        self.task = asyncio.ensure_future(self.write_loop())
+
+    def enqueue(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except asyncio.QueueFull:
+            log.warning("Dropping message to %s: send queue is full", self.addr)
+
+    async def connect(self):
+        delay = RECONNECT_MIN_DELAY
+        while self.transport.running:
+            try:
+                reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.addr), CONNECT_TIMEOUT)
+                asyncio.ensure_future(self.read_loop(reader, self.writer))
+                return True
+            except (OSError, asyncio.TimeoutError) as e:
+                log.info("Error connecting to %s - %s, retrying in %ss", self.addr, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+
+    async def write_loop(self):
+        while self.transport.running:
+            frame = await self.frames.get()
+            while self.transport.running:
+                if self.writer is None or self.writer.is_closing():
+                    if not await self.connect():
+                        return
+                try:
+                    self.writer.write(frame)
+                    await self.writer.drain()
+                    break
+                except (OSError, ConnectionError) as e:
+                    log.info("Error sending to %s - %s", self.addr, e)
+                    self.drop(self.writer)
+
+    async def read_loop(self, reader, writer):
+        try:
+            while self.transport.running:
+                req_id, payload = await read_frame(reader)
+                future = self.pending.pop(req_id, None)
+                if future is not None:
+                    try:
+                        future.set_result(payload)
+                    except InvalidStateError:
+                        pass  # Timed out or cancelled meanwhile, possibly from another thread
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            if self.transport.running:
+                log.info("Connection to %s lost - %s", self.addr, e)
+        self.drop(writer)
+
+    def drop(self, writer):
+        writer.close()
+        if self.writer is writer:
+            self.writer = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection to {self.addr} lost"))
+
+    def close(self):
+        self.task.cancel()
+        if self.writer is not None:
+            self.drop(self.writer)
+
+
+class AsyncTransport:
+    """
+    Runs all peer connections, the server and multicast discovery on one asyncio event loop in a
+    background thread. Its public methods are thread safe, and message handlers are run on a
+    thread pool so they may block (e.g. wait for a response from another peer).
+    on_message(payload, peer_host) returns the encoded response for requests, or None. peer_host is the
+    address the connection comes from, the only thing known about the sender that it can't make up.
+    """
+    def __init__(self, host, port, on_message):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.running = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name="gossip-loop")
+        self.handlers = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix="gossip-handler")
+        self.peers = {}  # addr -> AsyncPeer
+        self.tasks = set()
+        self.server = None
+        self.handler_slots = None
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self.loop).result()
+
+    async def _start_server(self):
+        self.handler_slots = asyncio.Semaphore(MAX_CONCURRENT_HANDLERS)
+        self.server = await asyncio.start_server(self.serve_peer, self.host, self.port)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def serve_peer(self, reader, writer):
+        try:
+            while self.running:
+                req_id, data = await read_frame(reader)
+                await self.handler_slots.acquire()
+                self._spawn(self.dispatch(req_id, data, writer))
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            log.debug("Peer connection closed: %s", e)
+        writer.close()
+
+    async def dispatch(self, req_id, data, writer):
+        try:
+            peer_host = writer.get_extra_info("peername")[0]
+            response = await self.loop.run_in_executor(self.handlers, self.on_message, data, peer_host)
+            if response is not None and req_id != 0 and not writer.is_closing():
+                writer.write(pack_frame(req_id, response))
+                await writer.drain()
+        except Exception as e:
+            log.warning("Error answering peer: %s", e)
+        finally:
+            self.handler_slots.release()
+
+    def _peer(self, addr) -> AsyncPeer:
+        peer = self.peers.get(addr)
+        if peer is None:
+            peer = self.peers[addr] = AsyncPeer(self, addr)
+        return peer
+
+    def send(self, addr, payload: bytes):
+        self.loop.call_soon_threadsafe(lambda: self._peer(addr).enqueue(pack_frame(0, payload)))
+
+    def request(self, addr, payload: bytes, timeout=None) -> Future:
+        """The future is cancelled if there is no response within timeout seconds (if given)."""
+        future = Future()
+
+        def start_request():
+            peer = self._peer(addr)
+            req_id = next(peer.ids)
+            peer.pending[req_id] = future
+            future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(peer.pending.pop, req_id, None))
+            if timeout is not None:
+                self.loop.call_later(timeout, future.cancel)
+            peer.enqueue(pack_frame(req_id, payload))
+
+        self.loop.call_soon_threadsafe(start_request)
+        return future
+
+    def submit(self, func, *args) -> Future:
+        """Runs func(*args) on a handler thread."""
+        return self.handlers.submit(func, *args)
+
+    def add_datagram_receiver(self, sock, on_datagram):
+        """Calls on_datagram(data, addr) on a handler thread for every datagram received on the bound socket."""
+        def received(data, addr):
+            self.loop.run_in_executor(self.handlers, on_datagram, data, addr)
+
+        async def register():
+            await self.loop.create_datagram_endpoint(lambda: DatagramReceiver(received), sock=sock)
+        asyncio.run_coroutine_threadsafe(register(), self.loop).result()
+
+    def call_every(self, period_seconds, func):
+        """Calls func() on a handler thread every period_seconds while the transport runs."""
+        async def repeat():
+            while self.running:
+                await self.loop.run_in_executor(self.handlers, func)
+                await asyncio.sleep(period_seconds)
+        self.loop.call_soon_threadsafe(lambda: self._spawn(repeat()))
+
+    def stop(self):
+        self.running = False
+
+        async def shutdown():
+            for peer in self.peers.values():
+                peer.close()
+            for task in list(self.tasks):
+                task.cancel()
+            if self.server is not None:
+                self.server.close()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.handlers.shutdown(wait=False)
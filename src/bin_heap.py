@@ -1,4 +1,9 @@
 from hashlib import sha256
+import itertools
+
+# Binary mode: leaves and inner nodes are hashed with different prefixes so a leaf can't pose as a node.
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
 
 def lsb(n):
     if n == 0:
@@ -18,19 +23,34 @@ def msb(n):
     return position
 
 class virt_bin_heap:
+    # Shared by all heaps so an epoch never repeats, even when a heap is replaced.
+    epochs = itertools.count()
+
     @staticmethod
     def hashes(data):
         return sha256(data.encode()).hexdigest()
 
+    @staticmethod
+    def to_digest(h):
+        """A legacy hex hash as raw digest bytes (digests are returned as is)."""
+        return bytes.fromhex(h) if isinstance(h, str) else h
+
+    @staticmethod
+    def to_hex(h):
+        return h.hex() if isinstance(h, bytes) else h
+
     """
     We need to account for a starting brolist because maybe we merged a lot in the start.
+    binary=True hashes raw 32 byte digests, ordered by position in the tree, instead of hex strings.
     """
-    def __init__(self, n=0, roots=None):
+    def __init__(self, n=0, roots=None, binary=False):
         self.n = n
+        self.binary = binary
         self.roots = roots if roots is not None else []
+        self.root_set = set(self.roots)  # Rebuilt whenever roots change
+        self.epoch = next(virt_bin_heap.epochs)  # Changes whenever roots change
         self.created = False
         self.brolist = None
-        self.curr_root = None
         self.pos = None
         self.money = None
 
@@ -51,6 +71,19 @@ class virt_bin_heap:
     
     def set_root(self, root_idx, new_hash):
         self.roots[-root_idx - 1] = new_hash
+        self.roots_changed()
+
+    def roots_changed(self):
+        # Called after self.roots changed. The set is replaced before the epoch moves, so whoever reads the new
+        # epoch (e.g. to cache a validation result under it) also gets the new roots, even from another thread.
+        self.root_set = set(self.roots)
+        self.epoch = next(virt_bin_heap.epochs)
+
+    def roots_bytes(self):
+        return [virt_bin_heap.to_digest(r) for r in self.roots]
+
+    def root_index(self):
+        return self.root_set
 
     def root_idx_by_bit(self, root_bit):
         mask = 1 << msb(self.n)
@@ -61,75 +94,130 @@ class virt_bin_heap:
             mask >>= 1
         return count
 
+    def leaf(self, data, pos):
+        if not self.binary:
+            return virt_bin_heap.hashes(str(data) + str(pos))
+        if isinstance(data, str):
+            data = data.encode()
+        return sha256(LEAF_PREFIX + pos.to_bytes(8, "big") + data).digest()
+
+    def combine(self, h, brother, brother_is_left):
+        """Hash of the parent of h and its brother. Legacy mode ignores the order of the two."""
+        if not self.binary:
+            return virt_bin_heap.hashes(str(h) + str(brother))
+        if brother_is_left:
+            return sha256(NODE_PREFIX + brother + h).digest()
+        return sha256(NODE_PREFIX + h + brother).digest()
+
+    def root_nodes(self, n=None):
+        """(level, idx) of every root, biggest tree first. Node (level, idx) covers positions idx * 2^level onwards."""
+        n = self.n if n is None else n
+        nodes = []
+        start = 0
+        for level in reversed(range(n.bit_length())):
+            if n >> level & 1:
+                nodes.append((level, start >> level))
+                start += 1 << level
+        return nodes
+
+    def set_node(self, level, idx, h):
+        """Called with every node hash insert_many and apply_updates compute, in postorder. Only roots are kept here."""
+        pass
+
     def insert(self, data):
         """roots is sorted s.t. roots[0] represents the biggest tree"""
-        if len(self.roots) is 0:
-            self.roots = [virt_bin_heap.hashes(str(data) + str(self.n))]
-            self.n = 1
-            return 0, []
-        
-        if self.n % 2 == 0:
-            # Even number of trees, add a new tree
-            self.roots.append(virt_bin_heap.hashes(str(data) + str(self.n)))
-            self.n += 1
-            return self.n - 1, []
-
-        h = virt_bin_heap.hashes(str(data) + str(self.n))
-        prev_lsb = lsb(self.n)
-        new_lsb = lsb(self.n + 1)
-        bro_lst = []
-
-        linked = False
-        for i in range(new_lsb - prev_lsb):
-            # Merge with the root corrosponding to 'i'.
-            if linked:
-                self.brolist.append(self.roots[-1])
-                self.curr_root += 1
-            elif self.created and self.curr_root == i:
-                self.brolist.append(h)
-                linked = True
-            h = virt_bin_heap.hashes(str(h) + str(self.roots[-1]))
-            bro_lst.append(self.roots[-1])
-            self.roots.pop()
-
-        self.roots.append(h)
-        self.n += 1
-        return self.n - 1, bro_lst
+        return self.insert_many([data])[0]
+
+    def insert_many(self, items):
+        """Inserts all items in one pass, returns the (pos, brolist) of each of them in the final forest."""
+        if not items:
+            return []
+        nodes = dict(zip(self.root_nodes(), self.roots))  # (level, idx) -> hash of the nodes we may need
+        stack = [(level, h) for (level, _), h in zip(self.root_nodes(), self.roots)]
+        first = self.n
+        for pos in range(first, first + len(items)):
+            h = self.leaf(items[pos - first], pos)
+            level = 0
+            nodes[(0, pos)] = h
+            self.set_node(0, pos, h)
+            while stack and stack[-1][0] == level:
+                h = self.combine(h, stack.pop()[1], True)  # The older tree is on the left
+                level += 1
+                nodes[(level, pos >> level)] = h
+                self.set_node(level, pos >> level, h)
+            stack.append((level, h))
+        self.n += len(items)
+        self.roots = [h for _, h in stack]
+        self.roots_changed()
+
+        final_roots = set(self.root_nodes())
+
+        def path_brothers(pos, level):
+            brothers = []
+            while (level, pos >> level) not in final_roots and (level, (pos >> level) ^ 1) in nodes:
+                brothers.append(nodes[(level, (pos >> level) ^ 1)])
+                level += 1
+            return brothers
+
+        if self.created:
+            self.brolist.extend(path_brothers(self.pos, len(self.brolist)))
+        return [(pos, path_brothers(pos, 0)) for pos in range(first, self.n)]
 
     # Creates the *current* user. Assumes the created user is the last one inserted.
     def create(self, brolist, money, pos=None):
         self.pos = self.n - 1 if pos is None else pos
         self.brolist = brolist
         self.money = money
-        self.curr_root = lsb(self.n)
         self.created = True
 
     @staticmethod
     def is_power_of2(num: int):
         return num == (1 << msb(num))
 
-    @staticmethod
-    def calc_hash(data, pos, bro_list):
-        h = virt_bin_heap.hashes(str(data) + str(pos))
-        for b in bro_list:
-            h = virt_bin_heap.hashes(str(h) + str(b))
+    def calc_hash(self, data, pos, bro_list):
+        h = self.leaf(data, pos)
+        for level, b in enumerate(bro_list):
+            # Trees start at a multiple of their size, so bit `level` of pos tells our side.
+            h = self.combine(h, b, (pos >> level) & 1 == 1)
         return h
 
     def valid(self, data, pos, bro_lst):
-        h = virt_bin_heap.hashes(str(data) + str(pos))
-        for b in bro_lst:
-            h = virt_bin_heap.hashes(str(h) + str(b))
-        return h in self.roots
+        return self.calc_hash(data, pos, bro_lst) in self.root_index()
 
     def set_money(self, money):
         self.money = money
     
     def change_data(self, data, pos, bro_list):
-        root_idx = self.root_idx_by_bit(self.root_bit_by_pos(pos))
-        root_hash = self.calc_hash(data, pos, bro_list)
-        if self.created and self.get_root(root_idx) in self.brolist:
-            self.brolist[self.brolist.index(root_idx)] = root_hash
-        self.set_root(root_idx, root_hash)
+        self.apply_updates([(data, pos, bro_list)])
+
+    def apply_updates(self, updates):
+        """
+        Sets the data of many leaves, given as (data, pos, brolist) with brolists of the forest before the batch.
+        Nodes changed by earlier updates replace the stale brothers of later ones, so all updates are kept.
+        """
+        if not updates:
+            return
+        root_at = {node: idx for idx, node in enumerate(self.root_nodes())}
+        changed = {}  # (level, idx) -> new hash
+        for data, pos, bro_list in updates:
+            root = (len(bro_list), pos >> len(bro_list))
+            if root not in root_at:
+                raise ValueError(f"A brolist of {len(bro_list)} hashes does not lead from {pos} to a root")
+            h = self.leaf(data, pos)
+            changed[(0, pos)] = h
+            self.set_node(0, pos, h)
+            for level, b in enumerate(bro_list):
+                b = changed.get((level, (pos >> level) ^ 1), b)
+                h = self.combine(h, b, (pos >> level) & 1 == 1)
+                changed[(level + 1, pos >> (level + 1))] = h
+                self.set_node(level + 1, pos >> (level + 1), h)
+            self.roots[root_at[root]] = h
+        self.roots_changed()
+        if self.created:
+            for level in range(len(self.brolist)):
+                brother = (level, (self.pos >> level) ^ 1)
+                if brother in changed:
+                    self.brolist[level] = changed[brother]
 
     def get_brolist(self):
         return self.brolist
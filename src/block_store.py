@@ -0,0 +1,202 @@
+import os
+import mmap
+import struct
+import zlib
+import threading
+from collections import OrderedDict
+from blockchain import Block, LOCAL_CHAIN_SIZE
+
+SEGMENT_SIZE = 64 * 1024 * 1024  # A new segment file is started once the current one passes this size
+SYNC_EVERY = 32  # Appended blocks between two fsyncs
+INDEX_FILE = "index.dat"
+
+# Index entry: block hash, height, segment number, offset in segment, record length
+INDEX_ENTRY = struct.Struct(">32sQIQI")
+# Segment record header: payload length, crc32 of payload
+RECORD_HEADER = struct.Struct(">II")
+
+
+def segment_name(segment: int):
+    return f"blk{segment:05d}.dat"
+
+
+class BlockStore:
+    """
+    Append-only block storage. Blocks are appended to segment files and located through an
+    index file of fixed size entries, loaded through mmap on startup. Writing an entry for a
+    hash that is already stored only moves it to the main chain at its height (used on reorg).
+    Only the last `hot_size` decoded blocks are kept in memory.
+    """
+    def __init__(self, path, hot_size=LOCAL_CHAIN_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.hot_size = hot_size
+        self.lock = threading.RLock()
+        self.by_hash = {}  # hash -> (height, segment, offset, length)
+        self.by_height = {}  # height -> hash on the main chain
+        self.hot = OrderedDict()  # hash -> Block
+        self.tip = None
+        self.unsynced = 0
+        self.segment = 0
+        self.segment_size = 0
+        self.readers = {}  # segment -> read fd
+        self._load_index()
+        self._remove_stale_segments()
+        self.segment_file = open(os.path.join(path, segment_name(self.segment)), "ab")
+        self.segment_file.truncate(self.segment_size)
+        self.index_file = open(os.path.join(path, INDEX_FILE), "ab")
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, segment_name(segment))
+
+    def _record_ok(self, segment, offset, length):
+        try:
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                header = f.read(RECORD_HEADER.size)
+                if len(header) != RECORD_HEADER.size:
+                    return False
+                size, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(size)
+                return size + RECORD_HEADER.size == length and len(payload) == size and zlib.crc32(payload) == crc
+        except FileNotFoundError:
+            return False
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path) or os.path.getsize(index_path) < INDEX_ENTRY.size:
+            open(index_path, "ab").close()
+            return
+        with open(index_path, "r+b") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                count = len(index) // INDEX_ENTRY.size
+                entries = [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size) for i in range(count)]
+            # Only the entries written after the last fsync may point at data that never made it to disk.
+            valid = count
+            for i in range(max(0, count - SYNC_EVERY), count):
+                _, _, segment, offset, length = entries[i]
+                if not self._record_ok(segment, offset, length):
+                    valid = i
+                    break
+            f.truncate(valid * INDEX_ENTRY.size)
+        for block_hash, height, segment, offset, length in entries[:valid]:
+            self.by_hash[block_hash] = (height, segment, offset, length)
+            self.by_height[height] = block_hash
+            self.tip = block_hash
+            if segment > self.segment or (segment == self.segment and offset + length > self.segment_size):
+                self.segment, self.segment_size = segment, offset + length
+
+    def _remove_stale_segments(self):
+        # Segments after the last indexed one were started before a crash lost their index entries.
+        for name in os.listdir(self.path):
+            if name.startswith("blk") and name.endswith(".dat") and name[3:-4].isdigit() and int(name[3:-4]) > self.segment:
+                os.remove(os.path.join(self.path, name))
+
+    def _read(self, segment, offset, length):
+        fd = self.readers.get(segment)
+        if fd is None:
+            fd = self.readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        record = os.pread(fd, length, offset)
+        size, crc = RECORD_HEADER.unpack_from(record)
+        payload = record[RECORD_HEADER.size:RECORD_HEADER.size + size]
+        if zlib.crc32(payload) != crc:
+            raise IOError(f"Corrupt block record in segment {segment} at {offset}")
+        return payload
+
+    def _remember(self, block):
+        self.hot[block.hash] = block
+        self.hot.move_to_end(block.hash)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def _write_index(self, block_hash, location):
+        height, segment, offset, length = location
+        self.index_file.write(INDEX_ENTRY.pack(block_hash, height, segment, offset, length))
+        self.by_height[height] = block_hash
+        self.tip = block_hash
+
+    def put(self, block: Block):
+        """Stores the block (if new) and makes it the main chain block at its height and the tip."""
+        if len(block.hash) != 32:
+            raise ValueError(f"Block hash must be 32 bytes, got {len(block.hash)}")
+        with self.lock:
+            location = self.by_hash.get(block.hash)
+            if location is None:
+                if self.segment_size >= SEGMENT_SIZE:
+                    self._sync()
+                    self.segment_file.close()
+                    self.segment += 1
+                    self.segment_size = 0
+                    self.segment_file = open(self._segment_path(self.segment), "wb")
+                payload = block.to_bytes()
+                record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+                self.segment_file.write(record)
+                location = (block.index, self.segment, self.segment_size, len(record))
+                self.segment_size += len(record)
+                self.by_hash[block.hash] = location
+            self._write_index(block.hash, location)
+            self._remember(block)
+            self.unsynced += 1
+            if self.unsynced >= SYNC_EVERY:
+                self._sync()
+
+    def get(self, block_hash: bytes):
+        with self.lock:
+            block = self.hot.get(block_hash)
+            if block is not None:
+                self.hot.move_to_end(block_hash)
+                return block
+            location = self.by_hash.get(block_hash)
+            if location is None:
+                return None
+            self.segment_file.flush()
+            _, segment, offset, length = location
+            block = Block.from_bytes(self._read(segment, offset, length), trusted=True)
+            self._remember(block)
+            return block
+
+    def __contains__(self, block_hash):
+        return block_hash in self.by_hash
+
+    def height_of(self, block_hash: bytes):
+        location = self.by_hash.get(block_hash)
+        return None if location is None else location[0]
+
+    def tip_height(self):
+        return None if self.tip is None else self.by_hash[self.tip][0]
+
+    def hash_at(self, height: int):
+        """Hash of the main chain block at the given height."""
+        tip_height = self.tip_height()
+        if tip_height is None or height > tip_height:
+            return None
+        return self.by_height.get(height)
+
+    def get_by_height(self, height: int):
+        block_hash = self.hash_at(height)
+        return None if block_hash is None else self.get(block_hash)
+
+    def on_main_chain(self, block_hash: bytes):
+        height = self.height_of(block_hash)
+        return height is not None and self.hash_at(height) == block_hash
+
+    def _sync(self):
+        # Data is synced before the index so a synced index entry never points at missing data.
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.unsynced = 0
+
+    def flush(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.segment_file.close()
+            self.index_file.close()
+            for fd in self.readers.values():
+                os.close(fd)
+            self.readers.clear()
@@ -1,224 +1,377 @@
+import logging
 import base64
 import time
 import hashlib
 import json
 from typing import List
-from security import sign, verify_signed
+from security import sign, verify_signed, decode_public_key
+from codec import Writer, Reader, write_header, read_header
+from lottery import ticket_hash
+from merkle import MerkleTree
+
+log = logging.getLogger(__name__)
 
 TRANSACTION_EXPIRATION = 100
 LOCAL_CHAIN_SIZE = TRANSACTION_EXPIRATION * 2
 
+# Object kinds of the binary wire format (see codec.py).
+KIND_BALANCE_INFO = 1
+KIND_TRANSACTION = 2
+KIND_BLOCK = 3
+KIND_BLOCK_REQUEST_HEART = 4
+KIND_BLOCK_REQUEST = 5
+KIND_BLOCK_HEADER = 6
+
+# Bounds of what the binary codec can encode, received values outside them are refused by validate().
+U64_MAX = (1 << 64) - 1
+I64_MIN = -(1 << 63)
+I64_MAX = (1 << 63) - 1
+MAX_SHORT_BYTES = 255
+MAX_HASH_SIZE = 32
+
 
 def shash(*args) -> bytes:
-    result = hashlib.sha256("|".join(str(arg) for arg in args).encode()).digest()
-    assert isinstance(result, bytes), f"shash result must be bytes, got {type(result)}"
-    return result
+    return hashlib.sha256("|".join(str(arg) for arg in args).encode()).digest()
 
 
 def bytes_to_string(string: bytes):
-    assert isinstance(string, bytes), f"bytes_to_string input must be bytes, got {type(string)}"
-    result = base64.b64encode(string).decode("ascii")
-    assert isinstance(result, str), f"bytes_to_string result must be str, got {type(result)}"
-    return result
+    return base64.b64encode(string).decode("ascii")
+
+
+def string_to_bytes(string: str) -> bytes:
+    return base64.b64decode(string.encode("ascii"), validate=True)
+
+
+class ValidationError(ValueError):
+    """A received object doesn't match the schema of its type."""
+
+
+def check(condition, message):
+    if not condition:
+        raise ValidationError(message)
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_u64(value):
+    return is_int(value) and 0 <= value <= U64_MAX
+
+
+def is_i64(value, minimum=I64_MIN):
+    return is_int(value) and minimum <= value <= I64_MAX
+
+
+def is_short_bytes(value, max_size=MAX_SHORT_BYTES):
+    return isinstance(value, bytes) and len(value) <= max_size
+
+
+def is_hash(value):
+    return is_short_bytes(value, MAX_HASH_SIZE)
+
+
+def is_bytes_list(value, max_size=MAX_SHORT_BYTES):
+    return isinstance(value, list) and all(is_short_bytes(b, max_size) for b in value)
+
+
+def is_key(value):
+    if not isinstance(value, str):
+        return False
+    try:
+        return bytes_to_string(string_to_bytes(value)) == value
+    except ValueError:
+        return False
+
+
+def decode(read, source, trusted):
+    """
+    read(source, trusted), then validates the object unless it comes from a trusted source (our own store).
+    This is the only place received objects are checked, objects we build ourselves are never checked.
+    """
+    if trusted:
+        return read(source, True)
+    try:
+        obj = read(source, False)
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise ValidationError(f"Malformed input for {read.__qualname__}: {e!r}") from e
+    obj.validate()
+    return obj
 
 
 class BalanceInfo:
+    __slots__ = ("brolist", "pos", "money", "public_key", "data")
+
     def __init__(self, brolist, pos, money, public_key):
-        print("Type brolist", type(brolist))
-        print("Type public_key", type(public_key))
-        assert isinstance(brolist, list), f"brolist must be list, got {type(brolist)}"
-        for b in brolist:
-            assert isinstance(b, bytes), f"brolist elements must be bytes, got {type(b)}"
-        assert isinstance(pos, int), f"pos must be int, got {type(pos)}"
-        assert isinstance(money, int), f"money must be int, got {type(money)}"
-        assert isinstance(public_key, str), f"public_key must be str, got {type(public_key)}"
-        assert base64.b64encode(base64.b64decode(public_key.encode("ascii"))).decode("ascii") == public_key, f"public_key {public_key} is not valid base64"
         self.brolist: List[bytes] = brolist
         self.pos: int = pos
         self.money: int = money
         self.public_key: str = public_key
-        self.data = shash(base64.b64decode(public_key.encode("ascii")), money)
-        print("Type data", type(self.data))
-        assert isinstance(self.data, bytes), f"data must be bytes, got {type(self.data)}"
+        self.data = shash(decode_public_key(public_key), money)
 
     def to_dict(self):
-        print("DEBUG: Entering BalanceInfo.to_dict")
-        result = {
+        return {
             "brolist": [bytes_to_string(b) for b in self.brolist],
             "pos": self.pos,
             "money": self.money,
             "public_key": self.public_key,
             "data": bytes_to_string(self.data)
         }
-        assert isinstance(result["brolist"], list), f"to_dict brolist must be list, got {type(result['brolist'])}"
-        for b in result["brolist"]:
-            assert isinstance(b, str), f"to_dict brolist elements must be str, got {type(b)}"
-            assert base64.b64encode(base64.b64decode(b.encode("ascii"))).decode("ascii") == b, f"to_dict brolist element {b} is not valid base64"
-        assert isinstance(result["pos"], int), f"to_dict pos must be int, got {type(result['pos'])}"
-        assert isinstance(result["money"], int), f"to_dict money must be int, got {type(result['money'])}"
-        assert isinstance(result["public_key"], str), f"to_dict public_key must be str, got {type(result['public_key'])}"
-        assert base64.b64encode(base64.b64decode(result["public_key"].encode("ascii"))).decode("ascii") == result["public_key"], f"to_dict public_key {result['public_key']} is not valid base64"
-        assert isinstance(result["data"], str), f"to_dict data must be str, got {type(result['data'])}"
-        assert base64.b64encode(base64.b64decode(result["data"].encode("ascii"))).decode("ascii") == result["data"], f"to_dict data {result['data']} is not valid base64"
-        return result
 
     @staticmethod
-    def from_dict(data):
-        print("Type data['brolist']", type(data["brolist"]))
-        print("Type data['public_key']", type(data["public_key"]))
-        assert isinstance(data, dict), f"from_dict data must be dict, got {type(data)}"
-        assert isinstance(data["brolist"], list), f"data['brolist'] must be list, got {type(data['brolist'])}"
-        for b in data["brolist"]:
-            assert isinstance(b, str), f"data['brolist'] elements must be str, got {type(b)}"
-            assert base64.b64encode(base64.b64decode(b.encode("ascii"))).decode("ascii") == b, f"data['brolist'] element {b} is not valid base64"
-        assert isinstance(data["pos"], int), f"data['pos'] must be int, got {type(data['pos'])}"
-        assert isinstance(data["money"], int), f"data['money'] must be int, got {type(data['money'])}"
-        assert isinstance(data["public_key"], str), f"data['public_key'] must be str, got {type(data['public_key'])}"
-        assert base64.b64encode(base64.b64decode(data["public_key"].encode("ascii"))).decode("ascii") == data["public_key"], f"data['public_key'] {data['public_key']} is not valid base64"
-        return BalanceInfo(
-            brolist=[base64.b64decode(b.encode("ascii")) for b in data["brolist"]],
+    def load(brolist, pos, money, public_key, data=None):
+        """Builds a BalanceInfo from already validated fields, without any checks."""
+        obj = BalanceInfo.__new__(BalanceInfo)
+        obj.brolist = brolist
+        obj.pos = pos
+        obj.money = money
+        obj.public_key = public_key
+        obj.data = shash(decode_public_key(public_key), money) if data is None else data
+        return obj
+
+    def validate(self):
+        check(is_bytes_list(self.brolist), "BalanceInfo brolist must be a list of at most 255 byte strings")
+        check(is_u64(self.pos), f"Invalid BalanceInfo pos {self.pos!r}")
+        check(is_i64(self.money, 0), f"Invalid BalanceInfo money {self.money!r}")
+        check(is_key(self.public_key), f"Invalid BalanceInfo public key {self.public_key!r}")
+
+    @staticmethod
+    def read_dict(data, trusted=False):
+        return BalanceInfo.load(
+            brolist=[string_to_bytes(b) for b in data["brolist"]],
             pos=data["pos"],
             money=data["money"],
-            public_key=data["public_key"]
+            public_key=data["public_key"],
+            data=string_to_bytes(data["data"]) if trusted and "data" in data else None
         )
 
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(BalanceInfo.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        w.u32(len(self.brolist))
+        for b in self.brolist:
+            w.short_bytes(b)
+        w.u64(self.pos)
+        w.i64(self.money)
+        w.key(self.public_key)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        brolist = [r.short_bytes() for _ in range(r.u32())]
+        pos = r.u64()
+        money = r.i64()
+        public_key = r.key()
+        return BalanceInfo.load(brolist=brolist, pos=pos, money=money, public_key=public_key)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_BALANCE_INFO)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_BALANCE_INFO)
+        return decode(BalanceInfo.read_from, r, trusted)
+
     def __hash__(self):
-        result = int.from_bytes(shash(base64.b64decode(self.public_key.encode("ascii")), self.money), 'big')
-        assert isinstance(result, int), f"__hash__ result must be int, got {type(result)}"
-        return result
+        return hash(self.data)  # data is shash(public key, money), computed once when built
+
+    def __eq__(self, other):
+        return isinstance(other, BalanceInfo) and self.data == other.data and self.pos == other.pos and \
+            self.brolist == other.brolist
 
 
 class Transaction:
+    __slots__ = ("amount", "expiration", "sender_balance", "receiver_balance", "signature", "hash")
+
     def __init__(self, amount, sender_balance, receiver_balance, curr_block_index,
                  blocks_till_expire=TRANSACTION_EXPIRATION):
-        print("Type sender_balance", type(sender_balance))
-        print("Type receiver_balance", type(receiver_balance))
-        assert isinstance(amount, int), f"amount must be int, got {type(amount)}"
-        assert isinstance(sender_balance, BalanceInfo), f"sender_balance must be BalanceInfo, got {type(sender_balance)}"
-        assert isinstance(receiver_balance, BalanceInfo), f"receiver_balance must be BalanceInfo, got {type(receiver_balance)}"
-        assert isinstance(curr_block_index, int), f"curr_block_index must be int, got {type(curr_block_index)}"
-        assert isinstance(blocks_till_expire, int), f"blocks_till_expire must be int, got {type(blocks_till_expire)}"
         self.amount = amount
         self.expiration = curr_block_index + blocks_till_expire
         self.sender_balance: BalanceInfo = sender_balance
         self.receiver_balance: BalanceInfo = receiver_balance
+        self.hash = None
         self.signature = sign(self.compute_hash())
-        print("Type signature", type(self.signature))
-        assert isinstance(self.signature, bytes), f"signature must be bytes, got {type(self.signature)}"
+
+    @staticmethod
+    def load(amount, expiration, sender_balance, receiver_balance, signature):
+        """Builds a received Transaction without signing it again or checking its fields."""
+        obj = Transaction.__new__(Transaction)
+        obj.amount = amount
+        obj.expiration = expiration
+        obj.sender_balance = sender_balance
+        obj.receiver_balance = receiver_balance
+        obj.signature = signature
+        obj.hash = None
+        return obj
+
+    def signature_item(self):
+        """(data, signature, public key) as expected by security.verify_many."""
+        return self.compute_hash(), self.signature, self.receiver_balance.public_key
 
     def validate_signature(self):
-        result = verify_signed(self.compute_hash(), self.signature, base64.b64decode(self.receiver_balance.public_key.encode("ascii")))
-        assert isinstance(result, bool), f"validate_signature result must be bool, got {type(result)}"
-        return result
+        return verify_signed(*self.signature_item())
 
     def compute_hash(self):
-        result = shash(
-            self.amount,
-            self.expiration,
-            self.sender_balance.data,
-            self.receiver_balance.data
-        )
-        assert isinstance(result, bytes), f"compute_hash result must be bytes, got {type(result)}"
-        return result
+        # A transaction never changes once built, so its hash is only computed once.
+        if self.hash is None:
+            self.hash = shash(
+                self.amount,
+                self.expiration,
+                self.sender_balance.data,
+                self.receiver_balance.data
+            )
+        return self.hash
 
     def to_dict(self):
-        print("DEBUG: Entering Transaction.to_dict")
-        result = {
+        return {
             "amount": self.amount,
             "expiration": self.expiration,
             "sender_balance": self.sender_balance.to_dict(),
             "receiver_balance": self.receiver_balance.to_dict(),
             "signature": bytes_to_string(self.signature)
         }
-        assert isinstance(result["amount"], int), f"to_dict amount must be int, got {type(result['amount'])}"
-        assert isinstance(result["expiration"], int), f"to_dict expiration must be int, got {type(result['expiration'])}"
-        assert isinstance(result["sender_balance"], dict), f"to_dict sender_balance must be dict, got {type(result['sender_balance'])}"
-        assert isinstance(result["receiver_balance"], dict), f"to_dict receiver_balance must be dict, got {type(result['receiver_balance'])}"
-        assert isinstance(result["signature"], str), f"to_dict signature must be str, got {type(result['signature'])}"
-        assert base64.b64encode(base64.b64decode(result["signature"].encode("ascii"))).decode("ascii") == result["signature"], f"to_dict signature {result['signature']} is not valid base64"
-        return result
+
+    def validate(self):
+        check(is_i64(self.amount, 1), f"Invalid Transaction amount {self.amount!r}")
+        check(is_u64(self.expiration), f"Invalid Transaction expiration {self.expiration!r}")
+        check(isinstance(self.sender_balance, BalanceInfo), "Transaction sender_balance must be a BalanceInfo")
+        check(isinstance(self.receiver_balance, BalanceInfo), "Transaction receiver_balance must be a BalanceInfo")
+        self.sender_balance.validate()
+        self.receiver_balance.validate()
+        check(isinstance(self.signature, bytes), "Transaction signature must be bytes")
 
     @staticmethod
-    def from_dict(data):
-        print("DEBUG: Entering Transaction.from_dict")
-        print("Type data['sender_balance']", type(data["sender_balance"]))
-        print("Type data['receiver_balance']", type(data["receiver_balance"]))
-        print("Type data['signature']", type(data["signature"]))
-        assert isinstance(data, dict), f"from_dict data must be dict, got {type(data)}"
-        assert isinstance(data["amount"], int), f"data['amount'] must be int, got {type(data['amount'])}"
-        assert isinstance(data["expiration"], int), f"data['expiration'] must be int, got {type(data['expiration'])}"
-        assert isinstance(data["sender_balance"], dict), f"data['sender_balance'] must be dict, got {type(data['sender_balance'])}"
-        assert isinstance(data["receiver_balance"], dict), f"data['receiver_balance'] must be dict, got {type(data['receiver_balance'])}"
-        assert isinstance(data["signature"], str), f"data['signature'] must be str, got {type(data['signature'])}"
-        assert base64.b64encode(base64.b64decode(data["signature"].encode("ascii"))).decode("ascii") == data["signature"], f"data['signature'] {data['signature']} is not valid base64"
-        transaction = Transaction(
+    def read_dict(data, trusted=False):
+        return Transaction.load(
             amount=data["amount"],
-            sender_balance=BalanceInfo.from_dict(data["sender_balance"]),
-            receiver_balance=BalanceInfo.from_dict(data["receiver_balance"]),
-            curr_block_index=data["expiration"] - TRANSACTION_EXPIRATION
+            expiration=data["expiration"],
+            sender_balance=BalanceInfo.read_dict(data["sender_balance"], trusted),
+            receiver_balance=BalanceInfo.read_dict(data["receiver_balance"], trusted),
+            signature=string_to_bytes(data["signature"])
         )
-        transaction.signature = base64.b64decode(data["signature"].encode("ascii"))
-        return transaction
+
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(Transaction.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        w.i64(self.amount)
+        w.u64(self.expiration)
+        self.sender_balance.write_to(w)
+        self.receiver_balance.write_to(w)
+        w.long_bytes(self.signature)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        amount = r.i64()
+        expiration = r.u64()
+        sender_balance = BalanceInfo.read_from(r, trusted)
+        receiver_balance = BalanceInfo.read_from(r, trusted)
+        signature = r.long_bytes()
+        return Transaction.load(amount, expiration, sender_balance, receiver_balance, signature)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_TRANSACTION)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_TRANSACTION)
+        return decode(Transaction.read_from, r, trusted)
 
     def __hash__(self):
-        result = int.from_bytes(self.compute_hash(), 'big')
-        assert isinstance(result, int), f"__hash__ result must be int, got {type(result)}"
-        return result
+        return hash(self.compute_hash())
+
+    def __eq__(self, other):
+        return isinstance(other, Transaction) and self.compute_hash() == other.compute_hash()
 
 
 class Block:
+    __slots__ = ("index", "prev_hash", "balance_info", "transactions", "new_users", "timestamp", "merkle",
+                 "med_hash", "pow_key", "hash")
+
     def __init__(self, index, prev_hash, balance_info, transactions, new_users, timestamp=None, pow_pub_key=None):
-        print("Type prev_hash", type(prev_hash))
-        print("Type balance_info", type(balance_info))
-        print("Type transactions", type(transactions))
-        print("Type new_users", type(new_users))
-        print("Type timestamp", type(timestamp))
-        print("Type pow_pub_key", type(pow_pub_key))
-        assert isinstance(index, int), f"index must be int, got {type(index)}"
-        assert isinstance(prev_hash, bytes), f"prev_hash must be bytes, got {type(prev_hash)}"
-        assert isinstance(balance_info, BalanceInfo), f"balance_info must be BalanceInfo, got {type(balance_info)}"
-        assert isinstance(transactions, list), f"transactions must be list, got {type(transactions)}"
-        for tx in transactions:
-            assert isinstance(tx, Transaction), f"transactions elements must be Transaction, got {type(tx)}"
-        assert isinstance(new_users, list), f"new_users must be list, got {type(new_users)}"
-        for u in new_users:
-            assert isinstance(u, str), f"new_users elements must be str, got {type(u)}"
-            assert base64.b64encode(base64.b64decode(u.encode("ascii"))).decode("ascii") == u, f"new_users element {u} is not valid base64"
-        assert isinstance(timestamp, (int, type(None))), f"timestamp must be int or None, got {type(timestamp)}"
-        assert isinstance(pow_pub_key, (bytes, type(None))), f"pow_pub_key must be bytes or None, got {type(pow_pub_key)}"
         self.index = index
         self.prev_hash = prev_hash
         self.balance_info: BalanceInfo = balance_info
         self.transactions = transactions  # list of Transaction
         self.new_users = new_users  # List of public keys (str)
         self.timestamp = int(time.time()) if timestamp is None else timestamp
+        self.merkle = None
         self.med_hash = self.compute_med_hash()
         self.pow_key = pow_pub_key
         self.hash = self.compute_hash()
-        print("Type pow_pub_key", type(self.pow_key))
-        print("Type med_hash", type(self.med_hash))
-        print("Type hash", type(self.hash))
-        assert isinstance(self.med_hash, bytes), f"med_hash must be bytes, got {type(self.med_hash)}"
-        assert isinstance(self.hash, bytes), f"hash must be bytes, got {type(self.hash)}"
+
+    @staticmethod
+    def load(index, prev_hash, balance_info, transactions, new_users, timestamp, pow_pub_key,
+             med_hash=None, block_hash=None):
+        """
+        Builds a Block without checking its fields. Hashes that are not given are computed,
+        given hashes are trusted as is.
+        """
+        obj = Block.__new__(Block)
+        obj.index = index
+        obj.prev_hash = prev_hash
+        obj.balance_info = balance_info
+        obj.transactions = transactions
+        obj.new_users = new_users
+        obj.timestamp = timestamp
+        obj.pow_key = pow_pub_key
+        obj.merkle = None
+        obj.med_hash = obj.compute_med_hash() if med_hash is None else med_hash
+        obj.hash = obj.compute_hash() if block_hash is None else block_hash
+        return obj
+
+    def merkle_tree(self) -> MerkleTree:
+        if self.merkle is None:
+            self.merkle = MerkleTree([tx.compute_hash() for tx in self.transactions])
+        return self.merkle
+
+    def merkle_root(self) -> bytes:
+        return self.merkle_tree().root()
+
+    def add_transaction(self, transaction):
+        """Appends a transaction while filling a block, updating the hashes in O(log n)."""
+        self.transactions.append(transaction)
+        self.merkle_tree().append(transaction.compute_hash())
+        self.med_hash = self.compute_med_hash()
+        self.hash = self.compute_hash()
+
+    def transaction_proof(self, tx_hash: bytes):
+        """Merkle inclusion proof of the transaction with the given hash, None if it isn't in the block."""
+        for idx, tx in enumerate(self.transactions):
+            if tx.compute_hash() == tx_hash:
+                return self.merkle_tree().proof(idx)
+        return None
 
     def compute_med_hash(self):
-        result = shash(
+        return shash(
             self.index,
             self.prev_hash,
             self.timestamp,
-            [tx.compute_hash() for tx in self.transactions]
+            self.merkle_root()
         )
-        assert isinstance(result, bytes), f"compute_med_hash result must be bytes, got {type(result)}"
-        return result
 
     def compute_hash(self):
-        result = shash(self.med_hash, self.pow_key if self.pow_key else "")
-        assert isinstance(result, bytes), f"compute_hash result must be bytes, got {type(result)}"
-        return result
+        return shash(self.med_hash, self.pow_key if self.pow_key else "")
+
+    @property
+    def stake(self):
+        return self.balance_info.money
+
+    def header(self):
+        return BlockHeader(self.index, self.prev_hash, self.timestamp, self.merkle_root(), self.pow_key, self.stake)
 
     def to_dict(self):
-        print("DEBUG: Entering Block.to_dict")
-        result = {
+        return {
             "index": self.index,
             "prev_hash": bytes_to_string(self.prev_hash),
             "balance_info": self.balance_info.to_dict(),
@@ -229,195 +382,344 @@ class Block:
             "hash": bytes_to_string(self.hash),
             "med_hash": bytes_to_string(self.med_hash)
         }
-        assert isinstance(result["index"], int), f"to_dict index must be int, got {type(result['index'])}"
-        assert isinstance(result["prev_hash"], str), f"to_dict prev_hash must be str, got {type(result['prev_hash'])}"
-        assert base64.b64encode(base64.b64decode(result["prev_hash"].encode("ascii"))).decode("ascii") == result["prev_hash"], f"to_dict prev_hash {result['prev_hash']} is not valid base64"
-        assert isinstance(result["balance_info"], dict), f"to_dict balance_info must be dict, got {type(result['balance_info'])}"
-        assert isinstance(result["transactions"], list), f"to_dict transactions must be list, got {type(result['transactions'])}"
-        for tx in result["transactions"]:
-            assert isinstance(tx, dict), f"to_dict transactions elements must be dict, got {type(tx)}"
-        assert isinstance(result["new_users"], list), f"to_dict new_users must be list, got {type(result['new_users'])}"
-        for u in result["new_users"]:
-            assert isinstance(u, str), f"to_dict new_users elements must be str, got {type(u)}"
-            assert base64.b64encode(base64.b64decode(u.encode("ascii"))).decode("ascii") == u, f"to_dict new_users element {u} is not valid base64"
-        assert isinstance(result["timestamp"], int), f"to_dict timestamp must be int, got {type(result['timestamp'])}"
-        assert isinstance(result["pow_key"], (str, type(None))), f"to_dict pow_key must be str or None, got {type(result['pow_key'])}"
-        if result["pow_key"] is not None:
-            assert base64.b64encode(base64.b64decode(result["pow_key"].encode("ascii"))).decode("ascii") == result["pow_key"], f"to_dict pow_key {result['pow_key']} is not valid base64"
-        assert isinstance(result["hash"], str), f"to_dict hash must be str, got {type(result['hash'])}"
-        assert base64.b64encode(base64.b64decode(result["hash"].encode("ascii"))).decode("ascii") == result["hash"], f"to_dict hash {result['hash']} is not valid base64"
-        assert isinstance(result["med_hash"], str), f"to_dict med_hash must be str, got {type(result['med_hash'])}"
-        assert base64.b64encode(base64.b64decode(result["med_hash"].encode("ascii"))).decode("ascii") == result["med_hash"], f"to_dict med_hash {result['med_hash']} is not valid base64"
-        return result
+
+    def validate(self):
+        check(is_u64(self.index), f"Invalid Block index {self.index!r}")
+        check(is_hash(self.prev_hash), "Block prev_hash must be a hash of at most 32 bytes")
+        check(isinstance(self.balance_info, BalanceInfo), "Block balance_info must be a BalanceInfo")
+        self.balance_info.validate()
+        check(isinstance(self.transactions, list), "Block transactions must be a list")
+        for tx in self.transactions:
+            check(isinstance(tx, Transaction), "Block transactions must be Transactions")
+            tx.validate()
+        check(isinstance(self.new_users, list), "Block new_users must be a list")
+        for u in self.new_users:
+            check(is_key(u), f"Invalid Block new user key {u!r}")
+        check(is_i64(self.timestamp), f"Invalid Block timestamp {self.timestamp!r}")
+        check(self.pow_key is None or isinstance(self.pow_key, bytes), "Block pow_key must be bytes or None")
 
     @staticmethod
-    def from_dict(data):
-        print("DEBUG: Entering Block.from_dict")
-        print("Type data['prev_hash']", type(data["prev_hash"]))
-        print("Type data['balance_info']", type(data["balance_info"]))
-        print("Type data['transactions']", type(data["transactions"]))
-        print("Type data['new_users']", type(data["new_users"]))
-        print("Type data['timestamp']", type(data["timestamp"]))
-        print("Type data['pow_key']", type(data["pow_key"]))
-        print("Type data['hash']", type(data["hash"]))
-        print("Type data['med_hash']", type(data["med_hash"]))
-        assert isinstance(data, dict), f"from_dict data must be dict, got {type(data)}"
-        assert isinstance(data["index"], int), f"data['index'] must be int, got {type(data['index'])}"
-        assert isinstance(data["prev_hash"], str), f"data['prev_hash'] must be str, got {type(data['prev_hash'])}"
-        assert base64.b64encode(base64.b64decode(data["prev_hash"].encode("ascii"))).decode("ascii") == data["prev_hash"], f"data['prev_hash'] {data['prev_hash']} is not valid base64"
-        assert isinstance(data["balance_info"], dict), f"data['balance_info'] must be dict, got {type(data['balance_info'])}"
-        assert isinstance(data["transactions"], list), f"data['transactions'] must be list, got {type(data['transactions'])}"
-        for tx in data["transactions"]:
-            assert isinstance(tx, dict), f"data['transactions'] elements must be dict, got {type(tx)}"
-        assert isinstance(data["new_users"], list), f"data['new_users'] must be list, got {type(data['new_users'])}"
-        for u in data["new_users"]:
-            assert isinstance(u, str), f"data['new_users'] elements must be str, got {type(u)}"
-            assert base64.b64encode(base64.b64decode(u.encode("ascii"))).decode("ascii") == u, f"data['new_users'] element {u} is not valid base64"
-        assert isinstance(data["timestamp"], int), f"data['timestamp'] must be int, got {type(data['timestamp'])}"
-        assert isinstance(data["pow_key"], (str, type(None))), f"data['pow_key'] must be str or None, got {type(data['pow_key'])}"
-        if data["pow_key"] is not None:
-            assert base64.b64encode(base64.b64decode(data["pow_key"].encode("ascii"))).decode("ascii") == data["pow_key"], f"data['pow_key'] {data['pow_key']} is not valid base64"
-        assert isinstance(data["hash"], str), f"data['hash'] must be str, got {type(data['hash'])}"
-        assert base64.b64encode(base64.b64decode(data["hash"].encode("ascii"))).decode("ascii") == data["hash"], f"data['hash'] {data['hash']} is not valid base64"
-        assert isinstance(data["med_hash"], str), f"data['med_hash'] must be str, got {type(data['med_hash'])}"
-        assert base64.b64encode(base64.b64decode(data["med_hash"].encode("ascii"))).decode("ascii") == data["med_hash"], f"data['med_hash'] {data['med_hash']} is not valid base64"
-        return Block(
+    def read_dict(data, trusted=False):
+        return Block.load(
             index=data["index"],
-            prev_hash=base64.b64decode(data["prev_hash"].encode("ascii")),
-            balance_info=BalanceInfo.from_dict(data["balance_info"]),
-            transactions=[Transaction.from_dict(tx) for tx in data["transactions"]],
+            prev_hash=string_to_bytes(data["prev_hash"]),
+            balance_info=BalanceInfo.read_dict(data["balance_info"], trusted),
+            transactions=[Transaction.read_dict(tx, trusted) for tx in data["transactions"]],
             new_users=data["new_users"],
             timestamp=data["timestamp"],
-            pow_pub_key=base64.b64decode(data["pow_key"].encode("ascii")) if data["pow_key"] else None
+            pow_pub_key=string_to_bytes(data["pow_key"]) if data["pow_key"] else None,
+            med_hash=string_to_bytes(data["med_hash"]) if trusted else None,
+            block_hash=string_to_bytes(data["hash"]) if trusted else None
         )
 
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(Block.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        w.u64(self.index)
+        w.short_bytes(self.prev_hash)
+        self.balance_info.write_to(w)
+        w.u32(len(self.transactions))
+        for tx in self.transactions:
+            tx.write_to(w)
+        w.u32(len(self.new_users))
+        for u in self.new_users:
+            w.key(u)
+        w.i64(self.timestamp)
+        w.opt_bytes(self.pow_key)
+        w.short_bytes(self.hash)
+        w.short_bytes(self.med_hash)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        index = r.u64()
+        prev_hash = r.short_bytes()
+        balance_info = BalanceInfo.read_from(r, trusted)
+        transactions = [Transaction.read_from(r, trusted) for _ in range(r.u32())]
+        new_users = [r.key() for _ in range(r.u32())]
+        timestamp = r.i64()
+        pow_key = r.opt_bytes()
+        block_hash = r.short_bytes()
+        med_hash = r.short_bytes()
+        if not trusted:
+            block_hash = med_hash = None
+        return Block.load(index, prev_hash, balance_info, transactions, new_users, timestamp, pow_key,
+                          med_hash=med_hash, block_hash=block_hash)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_BLOCK)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_BLOCK)
+        return decode(Block.read_from, r, trusted)
+
     def __hash__(self):
-        result = int.from_bytes(self.hash, 'big')
-        assert isinstance(result, int), f"__hash__ result must be int, got {type(result)}"
-        return result
+        return hash(self.hash)
+
+    def __eq__(self, other):
+        return isinstance(other, Block) and self.hash == other.hash
+
+
+class BlockHeader:
+    """
+    The fields of a block its hash commits to, plus its stake, so chains can be linked and compared without
+    the transactions. The hash is always computed from the fields, so a header can't lie about it.
+    The stake is not part of the hash, it is checked against the block body once that is fetched.
+    """
+    __slots__ = ("index", "prev_hash", "timestamp", "merkle_root", "pow_key", "stake", "med_hash", "hash")
+
+    def __init__(self, index, prev_hash, timestamp, merkle_root, pow_key, stake):
+        self.index = index
+        self.prev_hash = prev_hash
+        self.timestamp = timestamp
+        self.merkle_root = merkle_root
+        self.pow_key = pow_key
+        self.stake = stake
+        self.med_hash = shash(index, prev_hash, timestamp, merkle_root)
+        self.hash = shash(self.med_hash, pow_key if pow_key else "")
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __eq__(self, other):
+        return isinstance(other, BlockHeader) and self.hash == other.hash
+
+    def matches(self, block: Block) -> bool:
+        return block.hash == self.hash and block.stake == self.stake
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "prev_hash": bytes_to_string(self.prev_hash),
+            "timestamp": self.timestamp,
+            "merkle_root": bytes_to_string(self.merkle_root),
+            "pow_key": bytes_to_string(self.pow_key) if self.pow_key else None,
+            "stake": self.stake
+        }
+
+    def validate(self):
+        check(is_u64(self.index), f"Invalid BlockHeader index {self.index!r}")
+        check(is_hash(self.prev_hash), "BlockHeader prev_hash must be a hash of at most 32 bytes")
+        check(is_i64(self.timestamp), f"Invalid BlockHeader timestamp {self.timestamp!r}")
+        check(is_hash(self.merkle_root), "BlockHeader merkle_root must be a hash of at most 32 bytes")
+        check(self.pow_key is None or isinstance(self.pow_key, bytes), "BlockHeader pow_key must be bytes or None")
+        check(is_i64(self.stake, 0), f"Invalid BlockHeader stake {self.stake!r}")
+
+    @staticmethod
+    def read_dict(data, trusted=False):
+        return BlockHeader(
+            index=data["index"],
+            prev_hash=string_to_bytes(data["prev_hash"]),
+            timestamp=data["timestamp"],
+            merkle_root=string_to_bytes(data["merkle_root"]),
+            pow_key=string_to_bytes(data["pow_key"]) if data["pow_key"] else None,
+            stake=data["stake"]
+        )
+
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(BlockHeader.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        w.u64(self.index)
+        w.short_bytes(self.prev_hash)
+        w.i64(self.timestamp)
+        w.short_bytes(self.merkle_root)
+        w.opt_bytes(self.pow_key)
+        w.i64(self.stake)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        return BlockHeader(r.u64(), r.short_bytes(), r.i64(), r.short_bytes(), r.opt_bytes(), r.i64())
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_BLOCK_HEADER)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_BLOCK_HEADER)
+        return decode(BlockHeader.read_from, r, trusted)
 
 
 class BlockRequest_heart:
+    __slots__ = ("timestamp", "public_key", "hash", "ticket")
+
     def __init__(self, timestamp: int, public_key: str):
-        print("Type public_key", type(public_key))
-        assert isinstance(timestamp, int), f"timestamp must be int, got {type(timestamp)}"
-        assert isinstance(public_key, str), f"public_key must be str, got {type(public_key)}"
-        assert base64.b64encode(base64.b64decode(public_key.encode("ascii"))).decode("ascii") == public_key, f"public_key {public_key} is not valid base64"
         self.timestamp: int = timestamp
         self.public_key: str = public_key
         self.hash = self.compute_hash()
-        print("Type hash", type(self.hash))
-        assert isinstance(self.hash, bytes), f"hash must be bytes, got {type(self.hash)}"
+        self.ticket = None
+
+    @staticmethod
+    def load(timestamp, public_key, heart_hash=None):
+        obj = BlockRequest_heart.__new__(BlockRequest_heart)
+        obj.timestamp = timestamp
+        obj.public_key = public_key
+        obj.hash = obj.compute_hash() if heart_hash is None else heart_hash
+        obj.ticket = None
+        return obj
 
     def compute_hash(self):
-        result = hashlib.sha256(f"{self.timestamp}|{base64.b64decode(self.public_key.encode('ascii'))}".encode()).digest()
-        assert isinstance(result, bytes), f"compute_hash result must be bytes, got {type(result)}"
-        return result
+        return ticket_hash(self.timestamp, self.public_key)
 
     def int_hash(self):
-        result = int.from_bytes(self.hash, 'big')
-        assert isinstance(result, int), f"int_hash result must be int, got {type(result)}"
-        return result
+        # Compared many times while requests compete, so it is only converted once.
+        if self.ticket is None:
+            self.ticket = int.from_bytes(self.hash, 'big')
+        return self.ticket
 
     def to_dict(self):
-        print("DEBUG: Entering BlockRequest_heart.to_dict")
-        result = {
+        return {
             "timestamp": self.timestamp,
             "public_key": self.public_key,
             "hash": bytes_to_string(self.hash)
         }
-        assert isinstance(result["timestamp"], int), f"to_dict timestamp must be int, got {type(result['timestamp'])}"
-        assert isinstance(result["public_key"], str), f"to_dict public_key must be str, got {type(result['public_key'])}"
-        assert base64.b64encode(base64.b64decode(result["public_key"].encode("ascii"))).decode("ascii") == result["public_key"], f"to_dict public_key {result['public_key']} is not valid base64"
-        assert isinstance(result["hash"], str), f"to_dict hash must be str, got {type(result['hash'])}"
-        assert base64.b64encode(base64.b64decode(result["hash"].encode("ascii"))).decode("ascii") == result["hash"], f"to_dict hash {result['hash']} is not valid base64"
-        return result
+
+    def validate(self):
+        check(is_i64(self.timestamp), f"Invalid BlockRequest_heart timestamp {self.timestamp!r}")
+        check(is_key(self.public_key), f"Invalid BlockRequest_heart public key {self.public_key!r}")
 
     @staticmethod
-    def from_dict(data):
-        print("DEBUG: Entering BlockRequest_heart.from_dict")
-        print("Type data['public_key']", type(data["public_key"]))
-        print("Type data['hash']", type(data["hash"]))
-        assert isinstance(data, dict), f"from_dict data must be dict, got {type(data)}"
-        assert isinstance(data["timestamp"], int), f"data['timestamp'] must be int, got {type(data['timestamp'])}"
-        assert isinstance(data["public_key"], str), f"data['public_key'] must be str, got {type(data['public_key'])}"
-        assert base64.b64encode(base64.b64decode(data["public_key"].encode("ascii"))).decode("ascii") == data["public_key"], f"data['public_key'] {data['public_key']} is not valid base64"
-        assert isinstance(data["hash"], str), f"data['hash'] must be str, got {type(data['hash'])}"
-        assert base64.b64encode(base64.b64decode(data["hash"].encode("ascii"))).decode("ascii") == data["hash"], f"data['hash'] {data['hash']} is not valid base64"
-        obj = BlockRequest_heart(
-            timestamp=data["timestamp"],
-            public_key=data["public_key"]
-        )
-        obj.hash = base64.b64decode(data["hash"].encode("ascii"))
-        return obj
+    def read_dict(data, trusted=False):
+        return BlockRequest_heart.load(data["timestamp"], data["public_key"],
+                                       string_to_bytes(data["hash"]) if trusted else None)
+
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(BlockRequest_heart.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        w.i64(self.timestamp)
+        w.key(self.public_key)
+        w.short_bytes(self.hash)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        timestamp = r.i64()
+        public_key = r.key()
+        heart_hash = r.short_bytes()
+        return BlockRequest_heart.load(timestamp, public_key, heart_hash if trusted else None)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_BLOCK_REQUEST_HEART)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_BLOCK_REQUEST_HEART)
+        return decode(BlockRequest_heart.read_from, r, trusted)
 
     def __hash__(self):
-        result = int.from_bytes(self.hash, 'big')
-        assert isinstance(result, int), f"__hash__ result must be int, got {type(result)}"
-        return result
+        return hash(self.hash)
+
+    def __eq__(self, other):
+        return isinstance(other, BlockRequest_heart) and self.hash == other.hash
 
 
 class BlockRequest:
+    __slots__ = ("heart", "difficulty_factor", "roots", "n", "block", "hash")
+
     def __init__(self, heart: BlockRequest_heart, difficulty_factor: int, roots, n, block: Block):
-        print("Type heart", type(heart))
-        print("Type roots", type(roots))
-        print("Type block", type(block))
-        assert isinstance(heart, BlockRequest_heart), f"heart must be BlockRequest_heart, got {type(heart)}"
-        assert isinstance(difficulty_factor, int), f"difficulty_factor must be int, got {type(difficulty_factor)}"
-        assert isinstance(roots, list), f"roots must be list, got {type(roots)}"
-        for r in roots:
-            assert isinstance(r, bytes), f"roots elements must be bytes, got {type(r)}"
-        assert isinstance(n, int), f"n must be int, got {type(n)}"
-        assert isinstance(block, Block), f"block must be Block, got {type(block)}"
         self.heart: BlockRequest_heart = heart
         self.difficulty_factor = difficulty_factor
         self.roots = roots
         self.n = n
         self.block = block
+        self.hash = self.compute_hash()  # The block must not change after this
+
+    @staticmethod
+    def load(heart, difficulty_factor, roots, n, block):
+        obj = BlockRequest.__new__(BlockRequest)
+        obj.heart = heart
+        obj.difficulty_factor = difficulty_factor
+        obj.roots = roots
+        obj.n = n
+        obj.block = block
+        obj.hash = obj.compute_hash()
+        return obj
 
     def to_dict(self):
-        print("DEBUG: Entering BlockRequest.to_dict")
-        result = {
+        return {
             "heart": self.heart.to_dict(),
             "difficulty_factor": self.difficulty_factor,
             "roots": [bytes_to_string(r) if isinstance(r, bytes) else r for r in self.roots],
             "n": self.n,
             "block": self.block.to_dict()
         }
-        assert isinstance(result["heart"], dict), f"to_dict heart must be dict, got {type(result['heart'])}"
-        assert isinstance(result["difficulty_factor"], int), f"to_dict difficulty_factor must be int, got {type(result['difficulty_factor'])}"
-        assert isinstance(result["roots"], list), f"to_dict roots must be list, got {type(result['roots'])}"
-        for r in result["roots"]:
-            assert isinstance(r, str), f"to_dict roots elements must be str, got {type(r)}"
-            assert base64.b64encode(base64.b64decode(r.encode("ascii"))).decode("ascii") == r, f"to_dict roots element {r} is not valid base64"
-        assert isinstance(result["n"], int), f"to_dict n must be int, got {type(result['n'])}"
-        assert isinstance(result["block"], dict), f"to_dict block must be dict, got {type(result['block'])}"
-        return result
+
+    def validate(self):
+        check(isinstance(self.heart, BlockRequest_heart), "BlockRequest heart must be a BlockRequest_heart")
+        self.heart.validate()
+        # big_int writes the length of the two's complement bytes in one byte.
+        check(is_int(self.difficulty_factor) and (self.difficulty_factor.bit_length() + 8) // 8 <= MAX_SHORT_BYTES,
+              f"Invalid BlockRequest difficulty_factor {self.difficulty_factor!r}")
+        check(is_bytes_list(self.roots, MAX_HASH_SIZE), "BlockRequest roots must be a list of hashes of at most 32 bytes")
+        check(is_u64(self.n), f"Invalid BlockRequest n {self.n!r}")
+        check(isinstance(self.block, Block), "BlockRequest block must be a Block")
+        self.block.validate()
 
     @staticmethod
-    def from_dict(data):
-        print("DEBUG: Entering BlockRequest.from_dict")
-        print("Type data['heart']", type(data["heart"]))
-        print("Type data['roots']", type(data["roots"]))
-        print("Type data['block']", type(data["block"]))
-        assert isinstance(data, dict), f"from_dict data must be dict, got {type(data)}"
-        assert isinstance(data["heart"], dict), f"data['heart'] must be dict, got {type(data['heart'])}"
-        assert isinstance(data["difficulty_factor"], int), f"data['difficulty_factor'] must be int, got {type(data['difficulty_factor'])}"
-        assert isinstance(data["roots"], list), f"data['roots'] must be list, got {type(data['roots'])}"
-        for r in data["roots"]:
-            assert isinstance(r, str), f"data['roots'] elements must be str, got {type(r)}"
-            assert base64.b64encode(base64.b64decode(r.encode("ascii"))).decode("ascii") == r, f"data['roots'] element {r} is not valid base64"
-        assert isinstance(data["n"], int), f"data['n'] must be int, got {type(data['n'])}"
-        assert isinstance(data["block"], dict), f"data['block'] must be dict, got {type(data['block'])}"
-        return BlockRequest(
-            heart=BlockRequest_heart.from_dict(data["heart"]),
+    def read_dict(data, trusted=False):
+        return BlockRequest.load(
+            heart=BlockRequest_heart.read_dict(data["heart"], trusted),
             difficulty_factor=data["difficulty_factor"],
-            roots=[base64.b64decode(r.encode("ascii")) if isinstance(r, str) else r for r in data["roots"]],
+            roots=[string_to_bytes(r) for r in data["roots"]],
             n=data["n"],
-            block=Block.from_dict(data["block"])
+            block=Block.read_dict(data["block"], trusted)
         )
 
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(BlockRequest.read_dict, data, trusted)
+
+    def write_to(self, w: Writer):
+        self.heart.write_to(w)
+        w.big_int(self.difficulty_factor)
+        w.u32(len(self.roots))
+        for r in self.roots:
+            w.short_bytes(r)
+        w.u64(self.n)
+        self.block.write_to(w)
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        heart = BlockRequest_heart.read_from(r, trusted)
+        difficulty_factor = r.big_int()
+        roots = [r.short_bytes() for _ in range(r.u32())]
+        n = r.u64()
+        block = Block.read_from(r, trusted)
+        return BlockRequest.load(heart, difficulty_factor, roots, n, block)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_BLOCK_REQUEST)
+        self.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_BLOCK_REQUEST)
+        return decode(BlockRequest.read_from, r, trusted)
+
+    def compute_hash(self):
+        return shash(self.heart.hash, self.block.hash, self.difficulty_factor, self.n)
+
     def __hash__(self):
-        result = int.from_bytes(shash(self.heart.hash, self.block.hash, self.difficulty_factor, self.n), 'big')
-        assert isinstance(result, int), f"__hash__ result must be int, got {type(result)}"
-        return result
\ No newline at end of file
+        return hash(self.hash)
+
+    def __eq__(self, other):
+        return isinstance(other, BlockRequest) and self.hash == other.hash
\ No newline at end of file
@@ -1,18 +1,39 @@
-from blockchain import Block, Transaction, BlockRequest, BlockRequest_heart, BalanceInfo
-from gossip import GossipNode
+from blockchain import Block, Transaction, BlockRequest, BlockRequest_heart, BalanceInfo, LOCAL_CHAIN_SIZE, shash
+from gossip import GossipNode, MAX_BLOCKS_PER_REQUEST
+from block_store import BlockStore
+from mempool import Mempool
+from fork_choice import BlockTree
+from orphan_pool import OrphanPool
+from sync import HeaderSync
+from validation import BlockValidator
+from tournament import IntervalTournament
+from snapshot import Snapshot, SNAPSHOT_FILE
 from bin_heap import virt_bin_heap
-from security import get_public_key_str
-from utils import do_periodic
+from full_heap import full_bin_heap
+from security import get_public_key_str, decode_public_key
+from utils import do_periodic, LRUCache
+from lottery import best_ticket
+import os
 import time
+import threading
 import base64
+import logging
+
+log = logging.getLogger(__name__)
 
 DEBUG = True
 
 TRANSACTIONS_PER_BLOCK = 2 if DEBUG else 1000
 NEW_USERS_PER_BLOCK = 2 if DEBUG else 1000
 TIME_INTERVAL_SECONDS = 1
+FINALIZE_DELAY = 0.5  # Seconds after an interval ends that its block requests are still accepted
+FUTURE_INTERVALS = 1  # Intervals after the current one that block requests are accepted for (clock skew)
 USER_ADD_BROADCAST_PERIOD = 5
 POW_PAY = 1
+SIDE_BLOCKS_SIZE = 4 * MAX_BLOCKS_PER_REQUEST  # Blocks off the main chain kept in memory
+BALANCE_CACHE_SIZE = 100000  # Balance proofs whose validation result is remembered
+VERIFIED_TX_CACHE_SIZE = 100000  # Fully validated transactions remembered
+DATA_DIR = "chaindata"
 
 genesis_block = Block(
     index=0,
@@ -21,18 +42,43 @@ genesis_block = Block(
     transactions=[],
     new_users=[]
 )
-empty_money_bin = virt_bin_heap(0, [])
+empty_money_bin = virt_bin_heap(0, [], binary=True)
 
 
 class BlockchainUser:
-    def __init__(self, port: int, node_id: int, curr_max_time: int=TIME_INTERVAL_SECONDS, money_heap: virt_bin_heap=empty_money_bin, last_block: Block=genesis_block):
+    def __init__(self, port: int, node_id: int, curr_max_time: int=TIME_INTERVAL_SECONDS, money_heap: virt_bin_heap=empty_money_bin, last_block: Block=genesis_block, data_dir: str=None):
         self.money_heap: virt_bin_heap = money_heap
-        self.transactions = []
+        self.mempool = Mempool()
+        self.balance_cache = LRUCache(BALANCE_CACHE_SIZE)  # (data, pos, brolist, roots epoch) -> valid
+        self.verified_txs = LRUCache(VERIFIED_TX_CACHE_SIZE)  # (tx hash, roots epoch) -> signature
+        self.validator = BlockValidator(self)
         self.new_users = [get_public_key_str()]
-        self.blockchain = {last_block.hash: last_block}
+        self.data_dir = os.path.join(DATA_DIR, str(node_id)) if data_dir is None else data_dir
+        self.block_store = BlockStore(self.data_dir)
+        if self.block_store.tip is not None:
+            last_block = self.block_store.get(self.block_store.tip)
+        else:
+            self.block_store.put(last_block)
+        self.heap_hash = self.block_store.hash_at(0)  # The block the money heap is the state after
+        snapshot = Snapshot.load(os.path.join(self.data_dir, SNAPSHOT_FILE))
+        if money_heap is empty_money_bin and snapshot is not None and self.block_store.on_main_chain(snapshot.block_hash):
+            self.money_heap = snapshot.to_heap()
+            self.heap_hash = snapshot.block_hash
+        self.blockchain = {}  # Hot window of the main chain, older blocks are in block_store
+        self.side_blocks = LRUCache(SIDE_BLOCKS_SIZE)  # Known blocks that are not on the main chain
+        self.block_tree = BlockTree()
+        # The tree starts LOCAL_CHAIN_SIZE blocks below the tip, so branches forking off the recent main chain
+        # connect after a restart. Deeper forks are not followed.
+        for height in range(max(0, last_block.index - LOCAL_CHAIN_SIZE + 1), last_block.index + 1):
+            block = self.block_store.get_by_height(height)
+            self.blockchain[block.hash] = block
+            self.block_tree.add(block)
+        self.orphans = OrphanPool()  # Blocks waiting for their ancestors
         self.last_hash = last_block.hash  # TODO: There should be no initial last block hash
         self.curr_max_time = curr_max_time
-        self.curr_best_block_req: BlockRequest or None = None
+        self.tournament = IntervalTournament()  # Block requests on top of our tip, competing per interval
+        self.chain_lock = threading.RLock()
+        self.sync_lock = threading.Lock()  # Only one sync runs at a time
         self.valid = False # "valid" is whether we have been added to the network
         self.gossip: GossipNode = GossipNode("0.0.0.0", port, get_public_key_str(), node_id, self)
         do_periodic(self.request_add, [], USER_ADD_BROADCAST_PERIOD)
@@ -44,7 +90,7 @@ class BlockchainUser:
         return False
 
     def can_create(self):
-        return (len(self.new_users) >= NEW_USERS_PER_BLOCK or len(self.transactions) >= TRANSACTIONS_PER_BLOCK) and self.valid
+        return (len(self.new_users) >= NEW_USERS_PER_BLOCK or len(self.mempool) >= TRANSACTIONS_PER_BLOCK) and self.valid
 
     @staticmethod
     def get_interval(timestamp):
@@ -57,33 +103,87 @@ class BlockchainUser:
     def interval_time(interval):
         return interval*TIME_INTERVAL_SECONDS
 
+    @staticmethod
+    def interval_deadline(interval):
+        """When the interval is finalized: its best block request is committed and no other is accepted."""
+        return BlockchainUser.interval_time(interval + 1) + FINALIZE_DELAY
+
     def get_balance_info(self):
         return BalanceInfo(self.money_heap.brolist, self.money_heap.pos, self.money_heap.money, get_public_key_str())
 
+    def get_brolist(self, pos):
+        """The brolist of any position, if we keep the full state (see full_heap.py)."""
+        if isinstance(self.money_heap, full_bin_heap) and 0 <= pos < self.money_heap.n:
+            return self.money_heap.proof(pos)
+        return None
+
     def on_add_user(self, public_key):
         self.new_users.append(public_key)
 
-    def on_transact_verified(self, transact: Transaction):
-        if self.validate_transaction(transact):
-            self.transactions.append(transact)
+    def on_transact_verified(self, transact: Transaction) -> bool:
+        """Returns whether the transaction was accepted (so it is worth relaying)."""
+        return self.validate_transaction(transact) and self.mempool.add(transact)
 
     def get_last_block(self):
-        return self.blockchain[self.last_hash]
+        return self.get_local_block(self.last_hash)
 
-    def get_block(self, block_hash: bytes):
+    def get_local_block(self, block_hash: bytes):
         if block_hash in self.blockchain:
             return self.blockchain[block_hash]
-        else:
-            return self.gossip.get_block(block_hash)
+        block = self.side_blocks.get(block_hash)
+        if block is not None:
+            return block
+        return self.block_store.get(block_hash)
+
+    def get_block(self, block_hash: bytes):
+        block = self.get_local_block(block_hash)
+        if block is None:
+            block = self.gossip.get_block(block_hash)
+        return block
+
+    def on_chain(self, block_hash: bytes):
+        return block_hash in self.blockchain or self.block_store.on_main_chain(block_hash)
+
+    def add_block(self, block: Block):
+        """Adds the block on top of the main chain and persists it."""
+        self.block_store.put(block)  # First, so a block the store refuses leaves no trace
+        self.blockchain[block.hash] = block
+        self.block_tree.add(block)
+        self.side_blocks.pop(block.hash)
+        self.mempool.remove(block.transactions)
+        self.mempool.prune_expired(block.index + 1)
+        while len(self.blockchain) > LOCAL_CHAIN_SIZE:
+            del self.blockchain[next(iter(self.blockchain))]
 
     def validate_balance(self, balance: BalanceInfo):
-        return self.money_heap.valid(balance.data, balance.pos, balance.brolist)
+        # The epoch changes with every change of the roots, so stale results are never used.
+        key = (balance.data, balance.pos, tuple(balance.brolist), self.money_heap.epoch)
+        result = self.balance_cache.get(key)
+        if result is None:
+            result = self.money_heap.valid(balance.data, balance.pos, balance.brolist)
+            self.balance_cache.put(key, result)
+        return result
 
-    def validate_transaction(self, transaction: Transaction) -> bool:
+    def is_verified(self, transaction: Transaction, epoch: int) -> bool:
+        # The hash doesn't cover the signature, so a transaction with another signature is not a hit.
+        return self.verified_txs.get((transaction.compute_hash(), epoch)) == transaction.signature
+
+    def set_verified(self, transaction: Transaction, epoch: int):
+        self.verified_txs.put((transaction.compute_hash(), epoch), transaction.signature)
+
+    def validate_transaction(self, transaction: Transaction, check_signature: bool=True) -> bool:
+        epoch = self.money_heap.epoch
+        if self.is_verified(transaction, epoch):
+            return True
         balance_ok = self.validate_balance(transaction.sender_balance) and self.validate_balance(transaction.receiver_balance)
         money_ok = 0 < transaction.amount <= transaction.sender_balance.money
-        signature_ok = transaction.validate_signature()
-        return balance_ok and money_ok and signature_ok
+        if not (balance_ok and money_ok):
+            return False
+        if check_signature:
+            if not transaction.validate_signature():
+                return False
+            self.set_verified(transaction, epoch)
+        return True
 
     @staticmethod
     def is_pow_transaction(block, transaction: Transaction):
@@ -96,13 +196,7 @@ class BlockchainUser:
 
     # TODO: Check that goal is correct based on timestamp.
     def validate_block(self, block_request: BlockRequest) -> bool:
-        block = block_request.block
-        transactions_ok = all(self.validate_transaction(t) and t.expiration <= block.index for t in block.transactions)
-        # TODO: Maybe add better check and maybe check timestamp.
-        index_ok = block.index == 0 or block.index - 1 == self.get_block(block.prev_hash).index
-        pow_ok = self.pow_correct(block) and any(self.is_pow_transaction(block, t) for t in block.transactions)
-        heart_ok = block_request.heart.int_hash() < block.balance_info.money * self.calc_difficulty_factor()
-        return transactions_ok and index_ok and pow_ok and heart_ok
+        return self.validator.validate(block_request)
 
     def calc_difficulty_factor(self):
         return 1  # PLACEHOLDER (shouldn't start at 1)
@@ -112,93 +206,257 @@ class BlockchainUser:
 
     def create_blockrequest(self, min_time: int, max_time: int):
         difficulty_factor = self.calc_difficulty_factor()
-        print(self.last_hash, "\n\n\n\n\n\n\n\n\n")
-        new_index = self.blockchain[self.last_hash].index + 1
+        log.debug("Creating a block request on top of %s", self.last_hash.hex())
+        new_index = self.get_last_block().index + 1
         prev_hash = self.last_hash
         balance_info = self.get_balance_info()
-        block_transactions = self.transactions[:TRANSACTIONS_PER_BLOCK]
+        block_transactions = self.mempool.select(TRANSACTIONS_PER_BLOCK, new_index)
         block_users = self.new_users[:NEW_USERS_PER_BLOCK]
         block: Block = Block(new_index, prev_hash, balance_info, block_transactions, block_users, pow_pub_key=get_public_key_str())
 
-        min_hash_int = None
-        min_hash_req = None
         min_target_hash = balance_info.money * difficulty_factor
-        for timestamp in range(min_time, max_time):
-            heart: BlockRequest_heart = BlockRequest_heart(timestamp, get_public_key_str())
-            heart_hash_int = heart.int_hash()
-            if min_hash_int is None or heart_hash_int < min(min_hash_int, min_target_hash):
-                min_hash_int = heart_hash_int
-                block_request: BlockRequest = BlockRequest(heart, difficulty_factor, self.money_heap.roots, self.money_heap.n, block)
-                min_hash_req = block_request
-
-        if min_hash_int is not None:
+        ticket = best_ticket(min_time, max_time, get_public_key_str(), min_target_hash)
+
+        if ticket is not None:
+            # Only the winning ticket is turned into objects.
+            heart: BlockRequest_heart = BlockRequest_heart(ticket[0], get_public_key_str())
             # TODO: If pow isn't correct broadcast request for pow.
-            if not self.pow_correct(min_hash_req.block):
-                min_hash_req.block.pow = None
-                min_hash_req.block.hash = min_hash_req.block.compute_hash()
+            if not self.pow_correct(block):
+                block.pow_key = None
+                block.hash = block.compute_hash()
             else:
                 # Block is fully correct so we are valid!
                 self.valid = True
+            # The request's hash covers the block hash, so the block is final from here on.
+            min_hash_req: BlockRequest = BlockRequest(heart, difficulty_factor, self.money_heap.roots_bytes(), self.money_heap.n, block)
             self.gossip.broadcast_BlockRequest(min_hash_req)
-            self.transactions = self.transactions[TRANSACTIONS_PER_BLOCK:]
-            self.new_users = self.new_users[NEW_USERS_PER_BLOCK:]
-            self.last_hash = min_hash_req.block.hash
-            self.blockchain[self.last_hash] = min_hash_req.block
+            # Our request competes like any other, it is committed if it wins its interval.
+            self.tournament.add(self.get_interval(heart.timestamp), min_hash_req)
             return min_hash_req
         return None
 
-    def on_block_create_req(self, block_req: BlockRequest):
-        if self.validate_block(block_req):
-            block = block_req.block
-            if block.hash in self.blockchain and block.transactions != self.blockchain[block.hash].transactions:
-                print("Bad Actor! Sending the ninjas...")
-                return
+    def on_block_create_req(self, block_req: BlockRequest) -> bool:
+        """Returns whether the request was accepted (so it is worth relaying), parked orphans are not yet."""
+        interval = self.get_interval(block_req.heart.timestamp)
+        if interval > self.curr_interval() + FUTURE_INTERVALS:
+            return False  # Its interval hasn't started, and would keep it in memory until it is finalized
+        if block_req.block.prev_hash not in self.block_tree:
+            if self.below_tree(block_req.block):
+                return False
+            # Validating needs the parent, so the block waits until its ancestors are fetched.
+            if self.orphans.add(block_req.block, block_req):
+                self.fetch_ancestors(block_req.block.prev_hash)
+            return False
+        if block_req.block.prev_hash == self.last_hash and not self.tournament.may_win(interval, block_req):
+            return False  # Too late or beaten by a request we have, not worth validating
+        if not self.validate_block(block_req):
+            log.info("[FORK or STALE BLOCK] Ignored")
+            return False
+        block = block_req.block
+        known_block = self.get_local_block(block.hash)
+        if known_block is not None and block.transactions != known_block.transactions:
+            log.warning("Bad actor: block %s was sent with different transactions", block.hash.hex())
+            return False
 
-            if len(self.blockchain) == 0 or block.prev_hash == self.last_hash:
-                if self.curr_best_block_req is None or block_req.heart.int_hash() < self.curr_best_block_req.heart.int_hash():
-                    self.curr_best_block_req = block_req
+        with self.chain_lock:
+            extends_tip = len(self.blockchain) == 0 or block.prev_hash == self.last_hash
+            if extends_tip:
+                accepted = self.tournament.add(interval, block_req)
             else:
-                original_block = block
-                stake = blockchain_stake = 0
+                accepted = self.add_side_block(block)
+        if accepted and not extends_tip and self.block_tree.stake(block.hash) > self.block_tree.stake(self.last_hash):
+            self.reorg(block.hash)
+
+        log.info("[CHAIN LENGTH] %d", self.get_last_block().index + 1)
+        self.connect_orphans()
+        return accepted
+
+    def finalize_interval(self, interval):
+        """Closes the intervals up to the given one, committing the best request of each that still extends our tip."""
+        for closed, candidates in self.tournament.finalize(interval):
+            with self.chain_lock:
+                winner = next((req for req in candidates if req.block.prev_hash == self.last_hash), None)
+                if winner is None:
+                    continue
+                self.add_block(winner.block)
+                self.last_hash = winner.block.hash
+                # Join requests stay pending until a block that includes them is committed, ours or not.
+                joined = set(winner.block.new_users)
+                self.new_users = [u for u in self.new_users if u not in joined]
+            log.info("[CHAIN LENGTH] %d, interval %d won by %s", winner.block.index + 1, closed, winner.block.hash.hex())
+            self.connect_orphans()
+
+    def run_tournament(self):
+        while True:
+            closed = self.get_interval(int(time.time() - FINALIZE_DELAY)) - 1  # Latest interval past its deadline
+            try:
+                self.finalize_interval(closed)
+            except Exception:
+                log.exception("Error finalizing interval %d", closed)
+            time.sleep(max(0, self.interval_deadline(closed + 1) - time.time()))
 
-                while block.hash not in self.blockchain:
-                    stake += block.balance_info.money
-                    block = self.get_block(block.prev_hash)
+    def start_tournament(self):
+        """Finalizes every interval at its deadline from now on, in a background thread."""
+        threading.Thread(target=self.run_tournament, daemon=True, name="tournament").start()
 
-                curr_block = self.blockchain[self.last_hash]
-                while curr_block.hash != block.hash:
-                    blockchain_stake += curr_block.balance_info.money
-                    curr_block = self.blockchain[curr_block.prev_hash]
+    def add_side_block(self, block: Block) -> bool:
+        """
+        Adds a block whose parent is in the block tree, without making it part of the main chain.
+        Returns False if the tree refused it (its index doesn't follow its parent's).
+        """
+        if block.hash in self.block_tree:
+            return True
+        if not self.block_tree.add(block):
+            log.warning("Block %s has index %d, not after its parent", block.hash.hex(), block.index)
+            return False
+        self.side_blocks.put(block.hash, block)
+        return True
+
+    def below_tree(self, block) -> bool:
+        """Whether the block forks off below the root of the block tree, so it can never be connected."""
+        return block.prev_hash not in self.block_tree and block.index - 1 <= self.block_tree.root_height()
 
-                if stake > blockchain_stake:
-                    block_to_del = self.blockchain[self.last_hash]
-                    while block_to_del.hash != block.hash:
-                        del self.blockchain[block_to_del.hash]
-                        block_to_del = self.blockchain[block_to_del.prev_hash]
+    def fetch_ancestors(self, block_hash: bytes):
+        """Requests the block and its ancestors in the background, unless they are already being requested."""
+        if self.orphans.start_fetch(block_hash):
+            self.gossip.request_blocks(block_hash, MAX_BLOCKS_PER_REQUEST, lambda blocks: self.on_ancestors(block_hash, blocks))
+
+    def on_ancestors(self, block_hash: bytes, blocks):
+        self.orphans.end_fetch(block_hash)
+        pool_full = False
+        for block in blocks:
+            if block.hash in self.block_tree:
+                continue
+            if block.prev_hash in self.block_tree:
+                self.add_side_block(block)
+            elif not self.orphans.add(block) and block.hash not in self.orphans:
+                pool_full = True
+        if blocks and blocks[0].prev_hash not in self.block_tree:
+            if self.below_tree(blocks[0]):
+                log.info("Not following a branch that forks off below block %d", self.block_tree.root_height())
+            elif not pool_full:
+                self.fetch_ancestors(blocks[0].prev_hash)  # The branch goes back further than one request
+            else:
+                # The branch is longer than the pool holds, headers-first sync fetches it in windows instead.
+                log.info("Orphan pool is full, syncing instead of fetching more ancestors")
+                self.start_sync()
+        self.connect_orphans()
 
-                    while original_block.hash != block.hash:
-                        self.blockchain[original_block.hash] = original_block
-                        original_block = self.get_block(original_block.prev_hash)
+    def connect_orphans(self):
+        """Handles the orphans whose parent is now known, and then their own orphans."""
+        orphans = self.orphans.pop_connectable(self.block_tree.__contains__)
+        while orphans:
+            for block, block_req in orphans:
+                if block_req is not None:
+                    self.on_block_create_req(block_req)
+                else:
+                    self.add_side_block(block)
+            orphans = self.orphans.pop_connectable(self.block_tree.__contains__)
 
-            print(f"[CHAIN LENGTH] {len(self.blockchain)}")
+    def get_headers(self, locator, count: int):
+        """Headers of up to `count` main chain blocks after the first locator hash on our main chain."""
+        for block_hash in locator:
+            if self.block_store.on_main_chain(block_hash):
+                height = self.block_store.height_of(block_hash)
+                break
         else:
-            print("[FORK or STALE BLOCK] Ignored")
+            return []
+        headers = []
+        for height in range(height + 1, height + 1 + count):
+            block = self.block_store.get_by_height(height)
+            if block is None:
+                break
+            headers.append(block.header())
+        return headers
+
+    def sync(self) -> int:
+        """Catches up with the best chain of our peers, returns how many blocks were added."""
+        if not self.sync_lock.acquire(blocking=False):
+            return 0  # Already syncing
+        try:
+            added = HeaderSync(self).run()
+            if self.money_heap.n == 0:
+                self.load_peer_snapshot()
+            return added
+        finally:
+            self.sync_lock.release()
+
+    def start_sync(self):
+        """
+        Syncs in a thread of its own: sync waits on jobs it runs on the gossip handler threads, so running it on
+        one of them could leave none to run the jobs.
+        """
+        if not self.sync_lock.locked():
+            threading.Thread(target=self.sync, daemon=True, name="sync").start()
+
+    def snapshot(self, include_own=True) -> Snapshot:
+        # Labeled with the block the heap was last built from, which is behind the tip until blocks are applied.
+        return Snapshot.of(self.money_heap, self.get_local_block(self.heap_hash), include_own)
+
+    def save_snapshot(self):
+        self.snapshot().save(os.path.join(self.data_dir, SNAPSHOT_FILE))
+
+    def load_peer_snapshot(self) -> bool:
+        """Takes the money heap state most peers agree on, if it is of a block on our main chain."""
+        snapshot = self.gossip.get_snapshot()
+        if snapshot is None or not self.block_store.on_main_chain(snapshot.block_hash):
+            return False
+        self.money_heap = snapshot.to_heap()
+        self.heap_hash = snapshot.block_hash
+        return True
+
+    def get_ancestors(self, block_hash: bytes, count: int):
+        """Up to `count` blocks ending at block_hash, oldest first."""
+        blocks = []
+        block = self.get_local_block(block_hash)
+        while block is not None and len(blocks) < count:
+            blocks.append(block)
+            block = self.get_local_block(block.prev_hash)
+        blocks.reverse()
+        return blocks
+
+    def reorg(self, new_tip: bytes) -> bool:
+        """
+        Makes the branch ending at new_tip the main chain. Returns False, leaving the chain as it was, if a
+        block of the branch can't be found or our tip moved to another branch meanwhile.
+        """
+        ancestor = self.block_tree.common_ancestor(self.last_hash, new_tip)
+        # Every block of the new branch is resolved before anything changes, fetching missing ones may take a while.
+        new_blocks = []
+        for new_hash in self.block_tree.path(ancestor, new_tip):
+            block = self.get_block(new_hash)
+            if block is None:
+                log.warning("Not switching to %s: block %s is missing", new_tip.hex(), new_hash.hex())
+                return False
+            new_blocks.append(block)
+        with self.chain_lock:
+            if self.block_tree.common_ancestor(self.last_hash, new_tip) != ancestor or \
+                    self.block_tree.stake(new_tip) <= self.block_tree.stake(self.last_hash):
+                return False
+            for old_hash in self.block_tree.path(ancestor, self.last_hash):
+                old_block = self.blockchain.pop(old_hash, None)
+                if old_block is not None:
+                    self.side_blocks.put(old_hash, old_block)
+            for block in new_blocks:
+                self.add_block(block)
+            self.last_hash = new_tip
+        return True
 
     def add_block_to_heap(self, block):
-        for public_key in block.new_users:
-            self.money_heap.insert(public_key)
+        balances = {}  # pos -> [public key, money, brolist], so several transactions of one user add up
         for transact in block.transactions:
             if transact.receiver_balance.public_key == get_public_key_str():
                 self.money_heap.money += transact.amount
             if transact.sender_balance.public_key == get_public_key_str():
                 self.money_heap.money -= transact.amount
-            self.money_heap.change_data(
-                transact.sender_balance.money - transact.amount,
-                transact.sender,
-                transact.sender_balance.brolist
-            )
-            self.money_heap.change_data(
-                transact.receiver_balance.money + transact.amount,
-                transact.receiver,
-                transact.receiver_balance.brolist
-            )
+            for balance, change in ((transact.sender_balance, -transact.amount), (transact.receiver_balance, transact.amount)):
+                entry = balances.setdefault(balance.pos, [balance.public_key, balance.money, balance.brolist])
+                entry[1] += change
+        # The brolists are of the forest before this block, so update before the new users change its shape.
+        self.money_heap.apply_updates([
+            (shash(decode_public_key(public_key), money), pos, brolist)
+            for pos, (public_key, money, brolist) in balances.items()
+        ])
+        # Leaves hold the same data as BalanceInfo.data, new users start with no money.
+        self.money_heap.insert_many([shash(decode_public_key(public_key), 0) for public_key in block.new_users])
+        self.heap_hash = block.hash
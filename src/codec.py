@@ -0,0 +1,178 @@
+import struct
+import base64
+from security import decode_public_key
+
+WIRE_MAGIC = b"\xb1"
+WIRE_VERSION = 1
+
+KEY_INLINE = 0
+KEY_REF = 1
+
+# Object kind of a gossip message envelope, object kinds are defined in blockchain.py.
+KIND_MESSAGE = 0
+
+_U8 = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_I64 = struct.Struct(">q")
+
+
+class Writer:
+    """
+    Builds a binary payload. Public keys are written once and later occurrences
+    are written as a reference to their index in the key table of the payload.
+    """
+    def __init__(self):
+        self.parts = []
+        self.keys = {}
+
+    def u8(self, value: int):
+        self.parts.append(_U8.pack(value))
+
+    def u16(self, value: int):
+        self.parts.append(_U16.pack(value))
+
+    def u32(self, value: int):
+        self.parts.append(_U32.pack(value))
+
+    def u64(self, value: int):
+        self.parts.append(_U64.pack(value))
+
+    def i64(self, value: int):
+        self.parts.append(_I64.pack(value))
+
+    def big_int(self, value: int):
+        raw = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+        self.u8(len(raw))
+        self.parts.append(raw)
+
+    def short_bytes(self, value: bytes):
+        self.u8(len(value))
+        self.parts.append(value)
+
+    def long_bytes(self, value: bytes):
+        self.u32(len(value))
+        self.parts.append(value)
+
+    def opt_bytes(self, value):
+        if value is None:
+            self.u8(0)
+        else:
+            self.u8(1)
+            self.long_bytes(value)
+
+    def key(self, public_key: str):
+        idx = self.keys.get(public_key)
+        if idx is not None:
+            self.u8(KEY_REF)
+            self.u16(idx)
+            return
+        self.keys[public_key] = len(self.keys)
+        self.u8(KEY_INLINE)
+        self.long_bytes(decode_public_key(public_key))
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.parts)
+
+
+class Reader:
+    def __init__(self, data: bytes, offset: int = 0):
+        self.data = memoryview(data)
+        self.offset = offset
+        self.keys = []
+
+    def _take(self, size: int) -> bytes:
+        end = self.offset + size
+        if end > len(self.data):
+            raise ValueError(f"Truncated payload: need {size} bytes at offset {self.offset}")
+        result = self.data[self.offset:end].tobytes()
+        self.offset = end
+        return result
+
+    def _unpack(self, fmt: struct.Struct) -> int:
+        if self.offset + fmt.size > len(self.data):
+            raise ValueError(f"Truncated payload: need {fmt.size} bytes at offset {self.offset}")
+        value = fmt.unpack_from(self.data, self.offset)[0]
+        self.offset += fmt.size
+        return value
+
+    def u8(self) -> int:
+        return self._unpack(_U8)
+
+    def u16(self) -> int:
+        return self._unpack(_U16)
+
+    def u32(self) -> int:
+        return self._unpack(_U32)
+
+    def u64(self) -> int:
+        return self._unpack(_U64)
+
+    def i64(self) -> int:
+        return self._unpack(_I64)
+
+    def big_int(self) -> int:
+        return int.from_bytes(self._take(self.u8()), "big", signed=True)
+
+    def short_bytes(self) -> bytes:
+        return self._take(self.u8())
+
+    def long_bytes(self) -> bytes:
+        return self._take(self.u32())
+
+    def opt_bytes(self):
+        return self.long_bytes() if self.u8() else None
+
+    def key(self) -> str:
+        tag = self.u8()
+        if tag == KEY_REF:
+            idx = self.u16()
+            if idx >= len(self.keys):
+                raise ValueError(f"Unknown key reference {idx}")
+            return self.keys[idx]
+        if tag != KEY_INLINE:
+            raise ValueError(f"Unknown key tag {tag}")
+        public_key = base64.b64encode(self.long_bytes()).decode("ascii")
+        self.keys.append(public_key)
+        return public_key
+
+    def done(self) -> bool:
+        return self.offset == len(self.data)
+
+
+def write_header(writer: Writer, kind: int):
+    writer.parts.append(WIRE_MAGIC)
+    writer.u8(WIRE_VERSION)
+    writer.u8(kind)
+
+
+def read_header(reader: Reader, kind: int):
+    if reader._take(1) != WIRE_MAGIC:
+        raise ValueError("Not a binary payload")
+    version = reader.u8()
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version {version}")
+    got = reader.u8()
+    if got != kind:
+        raise ValueError(f"Expected object kind {kind}, got {got}")
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:1] == WIRE_MAGIC
+
+
+def encode_message(msg_type: str, payload: bytes) -> bytes:
+    w = Writer()
+    write_header(w, KIND_MESSAGE)
+    w.short_bytes(msg_type.encode("ascii"))
+    w.long_bytes(payload)
+    return w.getvalue()
+
+
+def decode_message(data: bytes):
+    r = Reader(data)
+    read_header(r, KIND_MESSAGE)
+    msg_type = r.short_bytes().decode("ascii")
+    payload = r.long_bytes()
+    return msg_type, payload
@@ -1,11 +1,12 @@
 from blockchain__impl import BlockchainUser
 from bin_heap import virt_bin_heap
+from log_config import setup_logging
 import time
 from pprint import pprint
 
 
 def start_node():
-    money_heap = virt_bin_heap(0, [])
+    money_heap = virt_bin_heap(0, [], binary=True)
     money_heap.create([], money=50, pos=0)
     user = BlockchainUser(5000, 0, money_heap=money_heap)
     
@@ -14,6 +15,7 @@ def start_node():
     if block_req is None:
         print("Failed to create starting block.")
         exit(1)
+    user.start_tournament()
     # print("Starting block created:")
     # pprint(block_req.to_dict())
     while True:
@@ -22,4 +24,5 @@ def start_node():
 
 
 if __name__ == "__main__":
+    setup_logging()
     start_node()
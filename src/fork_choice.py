@@ -0,0 +1,102 @@
+import threading
+
+
+class TreeNode:
+    __slots__ = ("hash", "height", "stake", "skip")
+
+    def __init__(self, block_hash, height, stake, skip):
+        self.hash = block_hash
+        self.height = height
+        self.stake = stake  # Sum of the stake (balance_info.money) of the block and all its known ancestors
+        self.skip = skip  # skip[k] is the ancestor 2^k blocks up
+
+
+class BlockTree:
+    """
+    Every block (or header) we know of, main chain and side branches, with its height, cumulative stake and skip
+    pointers, so comparing branches is O(1) and finding where two branches meet is O(log n).
+    The first block added is the root, every other block must come after its parent.
+    """
+    def __init__(self):
+        self.nodes = {}  # hash -> TreeNode
+        self.root = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def root_height(self):
+        """Height of the first block added, blocks whose parent is at or below it can never be added."""
+        return None if self.root is None else self.root.height
+
+    def add(self, block) -> bool:
+        """
+        Adds the block, returns False if its parent is unknown (and it is not the first block) or its index
+        doesn't follow the parent's, since the skip pointers rely on heights going up by one.
+        """
+        with self.lock:
+            if block.hash in self.nodes:
+                return True
+            parent = self.nodes.get(block.prev_hash)
+            if parent is None and self.nodes:
+                return False
+            if parent is not None and block.index != parent.height + 1:
+                return False
+            skip = []
+            ancestor = parent
+            while ancestor is not None:
+                skip.append(ancestor)
+                k = len(skip) - 1
+                ancestor = ancestor.skip[k] if k < len(ancestor.skip) else None
+            stake = block.stake + (parent.stake if parent is not None else 0)
+            node = self.nodes[block.hash] = TreeNode(block.hash, block.index, stake, skip)
+            if self.root is None:
+                self.root = node
+            return True
+
+    def stake(self, block_hash):
+        return self.nodes[block_hash].stake
+
+    def height(self, block_hash):
+        return self.nodes[block_hash].height
+
+    @staticmethod
+    def _ancestor(node: TreeNode, height) -> TreeNode:
+        k = len(node.skip) - 1
+        while node.height > height:
+            while node.height - (1 << k) < height or k >= len(node.skip):
+                k -= 1
+            node = node.skip[k]
+        return node
+
+    def ancestor(self, block_hash, height):
+        """Hash of the ancestor of the block at the given height."""
+        return self._ancestor(self.nodes[block_hash], height).hash
+
+    def common_ancestor(self, hash_a, hash_b):
+        """Hash of the last block both branches share."""
+        a = self.nodes[hash_a]
+        b = self.nodes[hash_b]
+        a = self._ancestor(a, min(a.height, b.height))
+        b = self._ancestor(b, a.height)
+        if a is b:
+            return a.hash
+        # Both stay at the same height, so their skip lists are as long, but each jump shortens them.
+        for k in reversed(range(len(a.skip))):
+            if k < len(a.skip) and a.skip[k] is not b.skip[k]:
+                a, b = a.skip[k], b.skip[k]
+        return a.skip[0].hash
+
+    def path(self, ancestor_hash, block_hash):
+        """Hashes of the blocks after the ancestor up to the block, oldest first."""
+        node = self.nodes[block_hash]
+        stop = self.nodes[ancestor_hash].height
+        hashes = []
+        while node.height > stop:
+            hashes.append(node.hash)
+            node = node.skip[0]
+        hashes.reverse()
+        return hashes
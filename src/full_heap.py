@@ -0,0 +1,102 @@
+import os
+import mmap
+import struct
+from bin_heap import virt_bin_heap
+
+DIGEST_SIZE = 32
+# State file: magic, number of leaves, then every node digest in postorder
+STATE_HEADER = struct.Struct(">4sQ")
+STATE_MAGIC = b"BHP1"
+
+
+def leaf_node_pos(pos):
+    """Postorder position of a leaf: the nodes of all full subtrees to its left come before it."""
+    return 2 * pos - bin(pos).count("1")
+
+
+def node_pos(level, idx):
+    start = idx << level
+    return leaf_node_pos(start) + (1 << (level + 1)) - 2  # A subtree of 2^level leaves ends with its root
+
+
+def node_count(n):
+    return leaf_node_pos(n)
+
+
+class full_bin_heap(virt_bin_heap):
+    """
+    virt_bin_heap that keeps every node, so it can serve the brolist of any position in O(log n).
+    Nodes are 32 byte digests in one flat array, in postorder (the order insert builds them in),
+    so appending leaves only appends to the array. Always uses binary hashing.
+    A heap loaded with readonly=True maps the saved file instead of reading it, and can't be changed.
+    """
+    def __init__(self, n=0, nodes=None, readonly=False):
+        super().__init__(0, [], binary=True)
+        self.nodes = bytearray() if nodes is None else nodes
+        self.readonly = readonly
+        self.n = n
+        self.roots = [self.node(level, idx) for level, idx in self.root_nodes()]
+        self.roots_changed()
+
+    def node(self, level, idx) -> bytes:
+        offset = node_pos(level, idx) * DIGEST_SIZE
+        return bytes(self.nodes[offset:offset + DIGEST_SIZE])
+
+    def set_node(self, level, idx, h):
+        offset = node_pos(level, idx) * DIGEST_SIZE
+        if offset == len(self.nodes):
+            self.nodes += h
+        else:
+            self.nodes[offset:offset + DIGEST_SIZE] = h
+
+    def check_writable(self):
+        if self.readonly:
+            raise ValueError("The heap was loaded read only")
+
+    def insert_many(self, items):
+        self.check_writable()
+        return super().insert_many(items)
+
+    def apply_updates(self, updates):
+        self.check_writable()
+        super().apply_updates(updates)
+
+    def leaf_hash(self, pos) -> bytes:
+        return self.node(0, pos)
+
+    def proof(self, pos):
+        """The brolist of the leaf at pos."""
+        if not 0 <= pos < self.n:
+            raise IndexError(f"No position {pos} in a heap of {self.n} leaves")
+        start = 0
+        for level in reversed(range(self.n.bit_length())):
+            if self.n >> level & 1:
+                if pos < start + (1 << level):
+                    break
+                start += 1 << level
+        return [self.node(l, (pos >> l) ^ 1) for l in range(level)]
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(STATE_HEADER.pack(STATE_MAGIC, self.n))
+            f.write(self.nodes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, readonly=False):
+        with open(path, "rb") as f:
+            magic, n = STATE_HEADER.unpack(f.read(STATE_HEADER.size))
+            if magic != STATE_MAGIC:
+                raise ValueError(f"{path} is not a heap state file")
+            size = node_count(n) * DIGEST_SIZE
+            if readonly:
+                # The mapping stays valid after the file is closed.
+                nodes = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[STATE_HEADER.size:]
+            else:
+                nodes = bytearray(f.read())
+            if len(nodes) != size:
+                raise ValueError(f"{path} should hold {size} bytes of nodes for {n} leaves, got {len(nodes)}")
+        return full_bin_heap(n, nodes, readonly)
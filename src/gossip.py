@@ -1,20 +1,37 @@
+import logging
 import socket
 import threading
 import json
-import time
 import struct
-from blockchain import Block, Transaction, BlockRequest
+import base64
+from concurrent.futures import Future
+from blockchain import BalanceInfo, Block, BlockHeader, Transaction, BlockRequest, bytes_to_string
+from codec import is_binary, encode_message, decode_message, Writer, Reader
+from async_transport import AsyncTransport
+from inventory import Inventory
+from snapshot import Snapshot
 # from main import get_balance_info, get_last_block
 
+log = logging.getLogger(__name__)
+
 MIN_REQ_TIME = 3
 MIN_REQ_ANS = 10
+MAX_BLOCKS_PER_REQUEST = 500  # Blocks sent at most in answer to one get_blocks request
+MAX_HEADERS_PER_REQUEST = 2000  # Headers sent at most in answer to one get_headers request
+MAX_GETDATA_PER_REQUEST = 500  # Objects asked for in one getdata request
 MULTICAST_GROUP = '224.0.0.1'
 MULTICAST_PORT = 5002
 DISCOVERY_INTERVAL = 5  # Seconds between multicast announcements
+USE_BINARY_WIRE = True  # Set to False to send JSON messages (easier to debug), both are always accepted
+
+# Messages whose binary payload is an encoded object rather than JSON.
+BINARY_OBJECT_MESSAGES = {"response", "transaction_verified", "create_block"}
+# Objects that are announced by hash ("inv") and fetched by peers that don't have them ("getdata").
+INVENTORY_TYPES = {"create_block": BlockRequest, "transaction_verified": Transaction}
 
 
 def most_common(lst):
-    print("DEBUG: Entering most_common")
+    log.debug("Entering most_common")
     if not lst:
         return None
     hashable_lst = [json.dumps(item, sort_keys=True) if isinstance(item, dict) else item for item in lst]
@@ -29,16 +46,17 @@ def most_common(lst):
 
 class GossipNode:
     def __init__(self, host, port, public_key_str, uid, blockchain_user):
-        print("DEBUG: Entering GossipNode.__init__")
+        log.debug("Entering GossipNode.__init__")
         self.host = host
         self.port = port
         self.peers = []  # Dynamic peer list
         self.public_key_str = public_key_str
         self.uid = uid
         self.user = blockchain_user
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((host, port))
-        self.server.listen()
+        self.binary = USE_BINARY_WIRE
+        self.inventory = Inventory()
+        self.transport = AsyncTransport(host, port, self.handle_message)
+        self.transport.start()
         self.running = True
 
         # assigned later
@@ -47,14 +65,13 @@ class GossipNode:
 
         # Start peer discovery
         self.start_multicast_discovery()
-        threading.Thread(target=self.accept_peers, daemon=True).start()
 
     def start_multicast_discovery(self):
-        print("DEBUG: Entering start_multicast_discovery")
+        log.debug("Entering start_multicast_discovery")
         # Multicast sender
         self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-        threading.Thread(target=self.send_multicast, daemon=True).start()
+        self.transport.call_every(DISCOVERY_INTERVAL, self.send_multicast)
 
         # Multicast receiver
         self.receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -62,139 +79,268 @@ class GossipNode:
         self.receiver_socket.bind(('', MULTICAST_PORT))
         mreq = struct.pack("4sl", socket.inet_aton(MULTICAST_GROUP), socket.INADDR_ANY)
         self.receiver_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        threading.Thread(target=self.receive_multicast, daemon=True).start()
+        self.transport.add_datagram_receiver(self.receiver_socket, self.receive_multicast)
 
     def send_multicast(self):
-        print("DEBUG: Entering send_multicast")
-        while self.running:
-            try:
-                message = json.dumps({'ip': self.host, 'port': self.port, 'uid': self.uid})
-                self.multicast_socket.sendto(message.encode(), (MULTICAST_GROUP, MULTICAST_PORT))
-                time.sleep(DISCOVERY_INTERVAL)
-            except Exception as e:
-                print(f"Error sending multicast: {e}")
+        log.debug("Entering send_multicast")
+        try:
+            message = json.dumps({'port': self.port, 'uid': self.uid})
+            self.multicast_socket.sendto(message.encode(), (MULTICAST_GROUP, MULTICAST_PORT))
+        except Exception as e:
+            log.warning("Error sending multicast: %s", e)
 
-    def receive_multicast(self):
-        print("DEBUG: Entering receive_multicast")
-        while self.running:
-            try:
-                data, addr = self.receiver_socket.recvfrom(1024)
-                message = json.loads(data.decode())
-                peer = (message['ip'], message['port'])
-                if peer not in self.peers and message['uid'] != self.uid:
-                    self.peers.append(peer)
-                    print(f"Discovered peer: {peer}")
-            except Exception as e:
-                print(f"Error receiving multicast: {e}")
+    def receive_multicast(self, data, addr):
+        log.debug("Entering receive_multicast")
+        try:
+            message = json.loads(data.decode())
+            # Peers are known by the host their packets come from, which is also the host their connections
+            # come from (see on_inv), not by the address they claim.
+            peer = (addr[0], message['port'])
+            if peer not in self.peers and message['uid'] != self.uid:
+                self.peers.append(peer)
+                log.info("Discovered peer: %s", peer)
+        except Exception as e:
+            log.warning("Error receiving multicast: %s", e)
+
+    def encode_message(self, msg_type, data, binary=None):
+        """bytes data is an already encoded binary object, anything else is sent as JSON."""
+        binary = self.binary if binary is None else binary
+        if isinstance(data, bytes):
+            return encode_message(msg_type, data)
+        if binary:
+            return encode_message(msg_type, json.dumps(data).encode())
+        return json.dumps({"type": msg_type, "data": data}).encode()
+
+    @staticmethod
+    def decode_message(raw):
+        """Returns (msg_type, msg_data, binary). Binary object payloads are left as bytes."""
+        if not is_binary(raw):
+            message = json.loads(raw.decode())
+            return message["type"], message["data"], False
+        msg_type, payload = decode_message(raw)
+        if msg_type in BINARY_OBJECT_MESSAGES:
+            return msg_type, payload if payload else None, True
+        return msg_type, json.loads(payload.decode()), True
+
+    def handle_message(self, data, peer_host=None):
+        """
+        Handles one message, returns the encoded response for requests and None otherwise.
+        peer_host is the address of the connection the message came in on.
+        """
+        log.debug("Entering handle_message")
+        try:
+            response_data = None
+            msg_type, msg_data, binary = self.decode_message(data)
+            log.debug("Received %s %r", msg_type, msg_data)
+            if msg_type == "request":
+                req_type = msg_data["type"]
+                req_data = msg_data["data"]
+                if req_type == "get_block":
+                    block = self.user.get_local_block(base64.b64decode(req_data.encode("ascii")))
+                    if block is not None:
+                        response_data = block.to_bytes() if binary else block.to_dict()
+                elif req_type == "getdata":
+                    if isinstance(req_data, list):  # A batch, answered with a list with None for the missing ones
+                        bodies = [self.inventory.get_body(base64.b64decode(h.encode("ascii")))
+                                  for h in req_data[:MAX_GETDATA_PER_REQUEST]]
+                        objects = [None if body is None else body[1] for body in bodies]
+                        response_data = self.encode_bodies(objects) if binary else \
+                            [None if obj is None else obj.to_dict() for obj in objects]
+                    else:
+                        body = self.inventory.get_body(base64.b64decode(req_data.encode("ascii")))
+                        if body is not None:
+                            response_data = body[1].to_bytes() if binary else body[1].to_dict()
+                elif req_type == "get_tx_proof":
+                    block = self.user.get_local_block(base64.b64decode(req_data["block"].encode("ascii")))
+                    proof = None if block is None else block.transaction_proof(base64.b64decode(req_data["tx"].encode("ascii")))
+                    if proof is not None:
+                        response_data = {"med_hash": bytes_to_string(block.med_hash),
+                                         "merkle_root": bytes_to_string(block.merkle_root()),
+                                         "proof": [[bytes_to_string(h), is_left] for h, is_left in proof]}
+                        if binary:
+                            response_data = json.dumps(response_data).encode()
+                elif req_type == "get_blocks":
+                    blocks = self.user.get_ancestors(base64.b64decode(req_data["hash"].encode("ascii")),
+                                                     min(req_data["count"], MAX_BLOCKS_PER_REQUEST))
+                    if blocks:
+                        response_data = self.encode_blocks(blocks) if binary else [b.to_dict() for b in blocks]
+                elif req_type == "get_headers":
+                    locator = [base64.b64decode(h.encode("ascii")) for h in req_data["locator"]]
+                    headers = self.user.get_headers(locator, min(req_data["count"], MAX_HEADERS_PER_REQUEST))
+                    if headers:
+                        response_data = self.encode_headers(headers) if binary else [h.to_dict() for h in headers]
+                elif req_type == "get_snapshot":
+                    snapshot = self.user.snapshot(include_own=False)
+                    response_data = snapshot.to_bytes() if binary else snapshot.to_dict()
+                elif req_type == "get_brolist":
+                    brolist = self.user.get_brolist(req_data)
+                    if brolist is not None:
+                        response_data = {"pos": req_data, "brolist": [bytes_to_string(b) for b in brolist]}
+                        if binary:
+                            response_data = json.dumps(response_data).encode()
+                if binary and response_data is None:
+                    response_data = b""
+                return self.encode_message("response", response_data, binary)
+            elif msg_type == "add_user":
+                self.user.on_add_user(msg_data)
+            elif msg_type == "req_send_money":
+                sender = msg_data.get("sender", None)
+                receiver = msg_data.get("receiver", None)
+                amount = msg_data.get("amount", None)
+                if receiver == self.uid:
+                    if receiver is None or amount is None:
+                        log.debug("Invalid transaction to verify")
+                        return None
+                    sender_balance = BalanceInfo.from_dict(msg_data["sender_balance"])
+                    receiver_balance = self.user.get_balance_info()
+                    curr_idx = self.user.get_last_block().index
+                    transact = Transaction(amount, sender_balance, receiver_balance, curr_idx)
+                    self.broadcast_transaction(transact)
+            elif msg_type == "req_get_money":
+                sender = msg_data.get("sender", None)
+                receiver = msg_data.get("receiver", None)
+                amount = msg_data.get("amount", None)
+                if sender == self.uid:
+                    if receiver is None or amount is None:
+                        log.debug("Invalid transaction to verify")
+                        return None
+                    receiver_balance = BalanceInfo.from_dict(msg_data["receiver_balance"])
+                    sender_balance = self.user.get_balance_info()
+                    curr_idx = self.user.get_last_block().index
+                    transact = Transaction(amount, sender_balance, receiver_balance, curr_idx)
+                    self.broadcast_transaction(transact)
+            elif msg_type == "inv":
+                # The sender only tells its listening port, the host is the one it connected from.
+                if peer_host is not None and isinstance(msg_data["port"], int):
+                    self.on_inv((peer_host, msg_data["port"]), msg_data["items"])
+            elif msg_type in INVENTORY_TYPES:
+                # Pushed by a peer that doesn't announce by hash.
+                obj = self.decode_object(msg_type, msg_data, binary)
+                if self.inventory.add(obj.compute_hash()):
+                    self.on_object(msg_type, obj)
+        except Exception as e:
+            log.warning("Error handling peer: %s", e)
+        return None
+
+    @staticmethod
+    def decode_object(msg_type, data, binary):
+        obj_type = INVENTORY_TYPES[msg_type]
+        return obj_type.from_bytes(data) if binary else obj_type.from_dict(data)
+
+    def on_object(self, msg_type, obj, source=None):
+        """Hands the object to the user, and relays it only if the user accepted it."""
+        accepted = False
+        if msg_type == "transaction_verified":
+            accepted = self.user.on_transact_verified(obj)
+        elif msg_type == "create_block":
+            accepted = self.user.on_block_create_req(obj)
+        if accepted:
+            self.announce(msg_type, obj, exclude=source)
 
-    def accept_peers(self):
-        print("DEBUG: Entering accept_peers")
-        while self.running:
-            conn, addr = self.server.accept()
-            threading.Thread(target=self.handle_peer, args=(conn,), daemon=True).start()
+    def on_inv(self, peer, items):
+        """Fetches the announced objects we haven't seen from the peer that announced them, in batches."""
+        log.debug("Entering on_inv")
+        wanted = []  # (msg_type, hash)
+        for msg_type, hash_str in items:
+            obj_hash = base64.b64decode(hash_str.encode("ascii"))
+            self.inventory.peer_has(peer, obj_hash)
+            if msg_type in INVENTORY_TYPES and self.inventory.add(obj_hash):
+                wanted.append((msg_type, obj_hash))
+        for start in range(0, len(wanted), MAX_GETDATA_PER_REQUEST):
+            self.fetch_objects(peer, wanted[start:start + MAX_GETDATA_PER_REQUEST])
 
-    def handle_peer(self, conn):
-        print("DEBUG: Entering handle_peer")
-        with conn:
+    def fetch_objects(self, peer, wanted):
+        """Asks the peer for the [(msg_type, hash)] objects in one getdata and hands over the ones it sent."""
+        message = self.encode_message("request", {"type": "getdata", "data": [bytes_to_string(h) for _, h in wanted]})
+        try:
+            # The transport cancels the request at the timeout, so it doesn't stay pending.
+            response_type, response_data, binary = self.decode_message(
+                self.transport.request(peer, message, timeout=MIN_REQ_TIME).result())
+            if response_type != "response" or response_data is None:
+                raise ValueError("no response")
+            bodies = self.decode_bodies(response_data)
+            if len(bodies) != len(wanted):
+                raise ValueError(f"{len(bodies)} objects in answer to {len(wanted)}")
+        except Exception as e:
+            log.warning("Error fetching %d objects from %s - %s", len(wanted), peer, e)
+            for _, obj_hash in wanted:
+                self.inventory.forget(obj_hash)  # Let another announcement of them through
+            return
+        for (msg_type, obj_hash), body in zip(wanted, bodies):
             try:
-                data = conn.recv(65536).decode()
-                message = json.loads(data)
-                response_data = None
-                msg_type, msg_data = message["type"], message["data"]
-                print("[*] Received Request", msg_type, msg_data)
-                if msg_type == "request":
-                    req_type = message["data"]["type"]
-                    req_data = message["data"]["data"]
-                    if req_type == "get_block" and req_data in self.user.blockchain:
-                        block = self.user.blockchain[req_data]
-                        response_data = block.to_dict()
-                    response = json.dumps({"type": "response", "data": response_data})
-                    conn.sendall(response.encode())
-                elif msg_type == "add_user":
-                    self.user.on_add_user(msg_data)
-                elif msg_type == "req_send_money":
-                    sender = msg_data.get("sender", None)
-                    sender_balance = msg_data.get("sender_balance", None)
-                    receiver = msg_data.get("receiver", None)
-                    amount = msg_data.get("amount", None)
-                    if receiver == self.uid:
-                        if receiver is None or amount is None:
-                            print("[*] DEBUG: Invalid Transaction To Verify")
-                            return
-                        receiver_balance = self.user.get_balance_info()
-                        curr_idx = self.user.get_last_block().index
-                        transact = Transaction(amount, sender_balance, receiver_balance, curr_idx)
-                        self.broadcast_data("transaction_verified", transact.to_dict())
-                elif msg_type == "req_get_money":
-                    sender = msg_data.get("sender", None)
-                    receiver = msg_data.get("receiver", None)
-                    receiver_balance = msg_data.get("sender_balance", None)
-                    amount = msg_data.get("amount", None)
-                    if sender == self.uid:
-                        if receiver is None or amount is None:
-                            print("[*] DEBUG: Invalid Transaction To Verify")
-                            return
-                        sender_balance = self.user.get_balance_info()
-                        curr_idx = self.user.get_last_block().index
-                        transact = Transaction(amount, sender_balance, receiver_balance, curr_idx)
-                        self.broadcast_data("transaction_verified", transact.to_dict())
-                elif msg_type == "transaction_verified":
-                    self.user.on_transact_verified(Transaction.from_dict(msg_data))
-                elif msg_type == "create_block":
-                    print("Im right shut up")
-                    self.user.on_block_create_req(BlockRequest.from_dict(msg_data))
-                    print("8\n\n\n\n\n")
+                if body is None:
+                    raise ValueError("not sent")
+                obj = self.decode_object(msg_type, body, binary)
+                if obj.compute_hash() != obj_hash:
+                    raise ValueError("a different object was sent")
             except Exception as e:
-                print(f"Error handling peer: {e}")
+                log.warning("Error fetching %s %s from %s - %s", msg_type, bytes_to_string(obj_hash), peer, e)
+                self.inventory.forget(obj_hash)  # Let another announcement of it through
+                continue
+            self.on_object(msg_type, obj, source=peer)
+
+    def announce(self, msg_type, obj, exclude=None):
+        """Sends the hash of the object to every peer that isn't known to have it already."""
+        log.debug("Entering announce")
+        obj_hash = obj.compute_hash()
+        self.inventory.add(obj_hash)
+        self.inventory.keep_body(obj_hash, msg_type, obj)
+        message = self.encode_message("inv", {"port": self.port, "items": [[msg_type, bytes_to_string(obj_hash)]]})
+        for peer in list(self.peers):
+            if peer == exclude or self.inventory.peer_knows(peer, obj_hash):
+                continue
+            self.inventory.peer_has(peer, obj_hash)
+            self.transport.send(peer, message)
 
     def broadcast_request(self, message_type, data, min_ans, interval, listener):
-        print("DEBUG: Entering broadcast_request")
+        log.debug("Entering broadcast_request")
         results = []
         results_lock = threading.Lock()
         response_count = 0
         stop_event = threading.Event()
 
-        def request_from_peer(ip, port):
-            print(f"DEBUG: Entering request_from_peer for {ip}:{port}")
+        message = self.encode_message("request", {"type": message_type, "data": data})
+
+        def on_response(future):
             nonlocal response_count
+            if future.cancelled():
+                return  # Cancelled below once enough peers answered, or timed out
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(interval)
-                    s.connect((ip, port))
-                    message = json.dumps({"type": "request", "data": {"type": message_type, "data": data}})
-                    s.sendall(message.encode())
-                    response_data = s.recv(65536).decode()
-                    response = json.loads(response_data)
-                    if response["type"] == "response" and response["data"] is not None:
-                        with results_lock:
-                            results.append(response["data"])
-                            response_count += 1
-                            if response_count >= min_ans:
-                                stop_event.set()
+                response_type, response_data, _ = self.decode_message(future.result())
+                if response_type == "response" and response_data is not None:
+                    with results_lock:
+                        results.append(response_data)
+                        response_count += 1
+                        if response_count >= min_ans:
+                            stop_event.set()
             except Exception as e:
-                print(f"Error requesting from {ip}:{port} - {e}")
+                log.warning("Error in response to %s - %s", message_type, e)
 
-        for ip, port in self.peers:
-            t = threading.Thread(target=request_from_peer, args=(ip, port), daemon=True)
-            t.start()
+        futures = [self.transport.request(peer, message) for peer in list(self.peers)]
+        for future in futures:
+            future.add_done_callback(on_response)
 
         stop_event.wait(timeout=interval)
+        for future in futures:
+            future.cancel()
+        with results_lock:
+            results = list(results)
         listener(results)
 
     def request_most_likely(self, type, data, listener):
-        print("DEBUG: Entering request_most_likely")
+        log.debug("Entering request_most_likely")
         def wrapper_listener(results):
-            print("DEBUG: Entering wrapper_listener")
+            log.debug("Entering wrapper_listener")
             listener(most_common(results))
         self.broadcast_request(type, data, MIN_REQ_ANS, MIN_REQ_TIME, wrapper_listener)
 
     def sync_request_most_likely(self, type, data, timeout=30.0):
-        print("DEBUG: Entering sync_request_most_likely")
+        log.debug("Entering sync_request_most_likely")
         result = [None]
         result_event = threading.Event()
 
         def on_res(res):
-            print("DEBUG: Entering on_res")
+            log.debug("Entering on_res")
             result[0] = res
             result_event.set()
 
@@ -203,47 +349,188 @@ class GossipNode:
         return result[0]
 
     def get_block(self, block_hash, listener=None):
-        print("DEBUG: Entering get_block")
+        log.debug("Entering get_block")
         inner_listener = (lambda result: listener(Block.from_dict(result)) if result is not None else None)
-        return self.sync_request_most_likely("get_block", block_hash)
+        result = self.sync_request_most_likely("get_block", bytes_to_string(block_hash))
+        if result is None:
+            return None
+        return Block.from_bytes(result) if isinstance(result, bytes) else Block.from_dict(result)
 
-    def broadcast_data(self, type, data):
-        print("DEBUG: Entering broadcast_data")
-        def request_from_peer(ip, port):
-            print(f"DEBUG: Entering request_from_peer for {ip}:{port}")
+    def get_tx_proof(self, block_hash, tx_hash):
+        """Merkle proof that the transaction is in the block, as (merkle root, [(sibling, is_left)]) or None."""
+        log.debug("Entering get_tx_proof")
+        result = self.sync_request_most_likely("get_tx_proof", {"block": bytes_to_string(block_hash), "tx": bytes_to_string(tx_hash)})
+        if result is None:
+            return None
+        if isinstance(result, bytes):
+            result = json.loads(result.decode())
+        proof = [(base64.b64decode(h.encode("ascii")), is_left) for h, is_left in result["proof"]]
+        return base64.b64decode(result["merkle_root"].encode("ascii")), proof
+
+    @staticmethod
+    def encode_blocks(blocks):
+        w = Writer()
+        w.u32(len(blocks))
+        for block in blocks:
+            w.long_bytes(block.to_bytes())
+        return w.getvalue()
+
+    @staticmethod
+    def decode_blocks(data):
+        if not isinstance(data, bytes):
+            return [Block.from_dict(b) for b in data]
+        r = Reader(data)
+        return [Block.from_bytes(r.long_bytes()) for _ in range(r.u32())]
+
+    @staticmethod
+    def encode_bodies(objects):
+        """Encoded objects of a getdata batch, empty for the ones we don't have."""
+        w = Writer()
+        w.u32(len(objects))
+        for obj in objects:
+            w.long_bytes(b"" if obj is None else obj.to_bytes())
+        return w.getvalue()
+
+    @staticmethod
+    def decode_bodies(data):
+        """The objects of a getdata batch left encoded (dicts or bytes), None for the missing ones."""
+        if not isinstance(data, bytes):
+            return list(data)
+        r = Reader(data)
+        return [r.long_bytes() or None for _ in range(r.u32())]
+
+    @staticmethod
+    def encode_headers(headers):
+        w = Writer()
+        w.u32(len(headers))
+        for header in headers:
+            header.write_to(w)
+        return w.getvalue()
+
+    @staticmethod
+    def decode_headers(data):
+        if not isinstance(data, bytes):
+            return [BlockHeader.from_dict(h) for h in data]
+        r = Reader(data)
+        headers = [BlockHeader.read_from(r) for _ in range(r.u32())]
+        for header in headers:
+            header.validate()
+        return headers
+
+    def request_peer(self, peer, req_type, data, timeout=MIN_REQ_TIME) -> Future:
+        """Sends a request to one peer. The future's result is the response data, None if the peer had nothing."""
+        result = Future()
+
+        def on_response(future):
+            if future.cancelled():
+                result.set_exception(TimeoutError(f"No response to {req_type} from {peer}"))
+                return
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((ip, port))
-                    message = json.dumps({"type": type, "data": data})
-                    s.sendall(message.encode())
+                response_type, response_data, _ = self.decode_message(future.result())
             except Exception as e:
-                print(f"Error requesting from {ip}:{port} - {e}")
+                result.set_exception(e)
+                return
+            result.set_result(response_data if response_type == "response" else None)
 
-        for ip, port in self.peers:
-            t = threading.Thread(target=request_from_peer, args=(ip, port), daemon=True)
-            t.start()
+        message = self.encode_message("request", {"type": req_type, "data": data})
+        self.transport.request(peer, message, timeout=timeout).add_done_callback(on_response)
+        return result
+
+    def request_blocks(self, block_hash, count, listener):
+        """
+        Asks peers one at a time, without blocking, for up to `count` blocks ending at block_hash.
+        listener(blocks) is called on a handler thread with the blocks oldest first, or [] if no peer had them.
+        """
+        log.debug("Entering request_blocks")
+        message = self.encode_message("request", {"type": "get_blocks", "data": {"hash": bytes_to_string(block_hash), "count": count}})
+        peers = list(self.peers)
+
+        def linked(blocks):
+            return blocks and blocks[-1].hash == block_hash and \
+                all(blocks[i].hash == blocks[i + 1].prev_hash for i in range(len(blocks) - 1))
+
+        def ask_next():
+            if not peers:
+                self.transport.submit(listener, [])
+                return
+            self.transport.request(peers.pop(), message, timeout=MIN_REQ_TIME).add_done_callback(on_response)
+
+        def on_response(future):
+            try:
+                if future.cancelled():
+                    raise TimeoutError("no response")
+                response_type, response_data, _ = self.decode_message(future.result())
+                if response_type == "response" and response_data is not None:
+                    blocks = self.decode_blocks(response_data)
+                    if linked(blocks):
+                        self.transport.submit(listener, blocks)
+                        return
+            except Exception as e:
+                log.warning("Error in response to get_blocks - %s", e)
+            ask_next()
+
+        ask_next()
+
+    def get_snapshot(self):
+        """The money heap snapshot (without anyone's own leaf) most peers answer with, or None."""
+        log.debug("Entering get_snapshot")
+        result = self.sync_request_most_likely("get_snapshot", None)
+        if result is None:
+            return None
+        try:
+            snapshot = Snapshot.from_bytes(result) if isinstance(result, bytes) else Snapshot.from_dict(result)
+        except ValueError as e:
+            log.warning("Bad snapshot from peers - %s", e)
+            return None
+        if snapshot.pos is not None:
+            log.warning("Peers sent a snapshot with someone's own leaf in it")
+            return None
+        return snapshot
+
+    def get_brolist(self, pos):
+        """The brolist of a position from a peer that keeps the full state, or None."""
+        log.debug("Entering get_brolist")
+        result = self.sync_request_most_likely("get_brolist", pos)
+        if result is None:
+            return None
+        if isinstance(result, bytes):
+            result = json.loads(result.decode())
+        return [base64.b64decode(b.encode("ascii")) for b in result["brolist"]]
+
+    def broadcast_data(self, type, data):
+        log.debug("Entering broadcast_data")
+        message = self.encode_message(type, data)
+        for peer in list(self.peers):
+            self.transport.send(peer, message)
 
     def broadcast_BlockRequest(self, block_req):
-        print("DEBUG: Entering broadcast_BlockRequest")
-        self.broadcast_data("create_block", block_req.to_dict())
+        log.debug("Entering broadcast_BlockRequest")
+        self.announce("create_block", block_req)
+
+    def broadcast_transaction(self, transact):
+        """Puts a transaction we made in our own mempool, and announces it if it was accepted there."""
+        log.debug("Entering broadcast_transaction")
+        if self.user.on_transact_verified(transact):
+            self.announce("transaction_verified", transact)
+        else:
+            log.warning("Not announcing transaction %s, it was not accepted locally", bytes_to_string(transact.compute_hash()))
 
     def broadcast_requestAdd(self):
-        print("DEBUG: Entering broadcast_requestAdd")
-        print("Sending request add")
-        print(type(self.public_key_str))
+        log.debug("Entering broadcast_requestAdd")
+        log.debug("Sending request add")
         self.broadcast_data("add_user", self.public_key_str)
 
     def broadcast_verifySendTransactionRequest(self, sender, sender_balance, receiver, amount):
-        print("DEBUG: Entering broadcast_verifySendTransactionRequest")
+        log.debug("Entering broadcast_verifySendTransactionRequest")
         self.broadcast_data("req_send_money", {"sender": sender, "sender_balance": sender_balance.to_dict(), "receiver": receiver, "amount": amount})
 
     def broadcast_verifyGetTransactionRequest(self, receiver, receiver_balance, sender, amount):
-        print("DEBUG: Entering broadcast_verifyGetTransactionRequest")
+        log.debug("Entering broadcast_verifyGetTransactionRequest")
         self.broadcast_data("req_get_money", {"receiver": receiver, "receiver_balance": receiver_balance.to_dict(), "sender": sender, "amount": amount})
 
     def stop(self):
-        print("DEBUG: Entering stop")
+        log.debug("Entering stop")
         self.running = False
-        self.server.close()
+        self.transport.stop()
         self.multicast_socket.close()
         self.receiver_socket.close()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import threading
+from utils import LRUCache
+
+SEEN_SIZE = 100000  # Object hashes this node remembers having received or announced
+PEER_SEEN_SIZE = 10000  # Object hashes remembered per peer
+RELAY_SIZE = 2048  # Announced objects kept to answer getdata requests
+
+
+class Inventory:
+    """
+    Tracks which objects (by hash) this node and each of its peers already have, so an object is
+    only announced to peers that may not have it and only fetched once.
+    """
+    def __init__(self):
+        self.seen = LRUCache(SEEN_SIZE)
+        self.peer_seen = {}  # peer -> LRUCache of hashes the peer has
+        self.bodies = LRUCache(RELAY_SIZE)  # hash -> (msg_type, object)
+        self.lock = threading.Lock()
+
+    def add(self, obj_hash: bytes) -> bool:
+        """Marks the hash as seen, returns False if it was already seen."""
+        with self.lock:
+            if obj_hash in self.seen:
+                return False
+            self.seen.put(obj_hash, True)
+            return True
+
+    def forget(self, obj_hash: bytes):
+        self.seen.pop(obj_hash)
+
+    def has(self, obj_hash: bytes) -> bool:
+        return obj_hash in self.seen
+
+    def _peer_seen(self, peer) -> LRUCache:
+        with self.lock:
+            seen = self.peer_seen.get(peer)
+            if seen is None:
+                seen = self.peer_seen[peer] = LRUCache(PEER_SEEN_SIZE)
+            return seen
+
+    def peer_has(self, peer, obj_hash: bytes):
+        self._peer_seen(peer).put(obj_hash, True)
+
+    def peer_knows(self, peer, obj_hash: bytes) -> bool:
+        return obj_hash in self._peer_seen(peer)
+
+    def keep_body(self, obj_hash: bytes, msg_type: str, obj):
+        self.bodies.put(obj_hash, (msg_type, obj))
+
+    def get_body(self, obj_hash: bytes):
+        """(msg_type, object) of an object we announced, or None."""
+        return self.bodies.get(obj_hash)
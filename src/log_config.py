@@ -0,0 +1,39 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOG_PROFILE_ENV = "LOG_PROFILE"
+
+# Level of each logger ("" is the root logger) per profile.
+PROFILES = {
+    "debug": {"": logging.DEBUG},
+    "default": {"": logging.INFO, "async_transport": logging.WARNING},
+    # Records below WARNING are dropped by logging.disable before any formatting or handler work.
+    "production": {"": logging.WARNING},
+}
+
+
+def setup_logging(profile=None, levels=None, stream=None):
+    """
+    Sends every record through a queue to a listener thread that writes it, so logging calls never wait
+    on the terminal. profile defaults to $LOG_PROFILE or "default", levels overrides single loggers.
+    Returns the listener, which is stopped at exit.
+    """
+    profile = profile or os.environ.get(LOG_PROFILE_ENV, "default")
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(records)]
+    for name, level in {**PROFILES[profile], **(levels or {})}.items():
+        logging.getLogger(name).setLevel(level)
+    logging.disable(logging.INFO if profile == "production" else logging.NOTSET)
+    return listener
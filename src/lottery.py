@@ -0,0 +1,66 @@
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from security import decode_public_key
+
+PARALLEL_WINDOW = 1 << 16  # Windows with more timestamps than this are split across worker processes
+LOTTERY_WORKERS = os.cpu_count() or 1
+
+_lottery_pool = None
+_lottery_pool_lock = threading.Lock()
+
+
+def ticket_suffix(public_key_str: str) -> bytes:
+    """The part of a ticket that doesn't depend on the timestamp."""
+    return f"|{decode_public_key(public_key_str)}".encode()
+
+
+def ticket_hash(timestamp: int, public_key_str: str) -> bytes:
+    """The hash of a BlockRequest_heart, sha256 of "<timestamp>|<raw public key>"."""
+    return hashlib.sha256(b"%d" % timestamp + ticket_suffix(public_key_str)).digest()
+
+
+def scan(min_time: int, max_time: int, suffix: bytes):
+    """Lowest ticket hash in [min_time, max_time) as (hash, timestamp), None for an empty window."""
+    sha256 = hashlib.sha256
+    # Equal length big-endian digests compare like the integers they encode.
+    return min(((sha256(b"%d" % timestamp + suffix).digest(), timestamp) for timestamp in range(min_time, max_time)),
+               default=None)
+
+
+def _get_pool():
+    global _lottery_pool
+    with _lottery_pool_lock:
+        if _lottery_pool is None:
+            # Forking a process that runs threads (gossip, tournament) can copy locks held by them, so the workers
+            # are spawned. Hashing short inputs holds the GIL, so threads wouldn't help.
+            _lottery_pool = ProcessPoolExecutor(max_workers=LOTTERY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _lottery_pool
+
+
+def lowest_ticket(min_time: int, max_time: int, public_key_str: str):
+    """Lowest ticket of the window as (timestamp, int value), None for an empty window."""
+    suffix = ticket_suffix(public_key_str)
+    if max_time - min_time <= PARALLEL_WINDOW or LOTTERY_WORKERS == 1:
+        best = scan(min_time, max_time, suffix)
+    else:
+        step = -(-(max_time - min_time) // LOTTERY_WORKERS)
+        starts = range(min_time, max_time, step)
+        results = _get_pool().map(scan, starts, [min(start + step, max_time) for start in starts], [suffix] * len(starts))
+        best = min((r for r in results if r is not None), default=None)
+    if best is None:
+        return None
+    return best[1], int.from_bytes(best[0], "big")
+
+
+def best_ticket(min_time: int, max_time: int, public_key_str: str, target: int):
+    """
+    The ticket to build a block request with: the lowest ticket if it is below target, otherwise the
+    first ticket of the window. Returns (timestamp, int value), None for an empty window.
+    """
+    lowest = lowest_ticket(min_time, max_time, public_key_str)
+    if lowest is None or lowest[1] < target:
+        return lowest
+    return min_time, int.from_bytes(ticket_hash(min_time, public_key_str), "big")
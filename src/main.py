@@ -1,6 +1,7 @@
 import sys, time, threading
 from blockchain__impl import BlockchainUser
 from security import get_public_key_str
+from log_config import setup_logging
 from colorama import init, Fore, Style
 
 # Initialize colorama for colorful terminal output
@@ -11,6 +12,8 @@ def start_node(node_id):
     port = 5000 + int(node_id)
     user = BlockchainUser(port, node_id)
     time.sleep(2)  # Wait briefly for peer discovery
+    print(f"Synced {user.sync()} blocks from peers")
+    user.start_tournament()
 
     # Start CLI in a separate thread
     cli_thread = threading.Thread(target=process_commands, args=(user,), daemon=True)
@@ -23,7 +26,7 @@ def start_node(node_id):
         print("Trying to create block.")
         interval = user.curr_interval()
         user.create_blockrequest(user.interval_time(interval), user.interval_time(interval + 1))
-        time.sleep(user.interval_time(interval + 1) - time.time())  # Wait until next interval
+        time.sleep(max(0, user.interval_deadline(interval) - time.time()))  # Wait until the interval has a winner
 
 
 def process_commands(user):
@@ -92,6 +95,8 @@ def process_commands(user):
             elif cmd == "exit":
                 print(f"{Fore.YELLOW}Shutting down node...{Style.RESET_ALL}")
                 user.gossip.stop()
+                user.save_snapshot()
+                user.block_store.close()
                 sys.exit(0)
 
             else:
@@ -107,4 +112,5 @@ if __name__ == "__main__":
     if len(sys.argv) < 2:
         print(f"{Fore.RED}Usage: python main.py <node_id>{Style.RESET_ALL}")
         sys.exit(1)
+    setup_logging()
     start_node(sys.argv[1])
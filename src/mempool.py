@@ -0,0 +1,92 @@
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from blockchain import Transaction
+
+MAX_MEMPOOL_SIZE = 100000  # Transactions kept waiting for a block, new ones are rejected beyond this
+
+
+class Mempool:
+    """
+    Transactions waiting to be put in a block, indexed by hash, by sender and by expiration.
+    Blocks take transactions in arrival order (there are no fees to order by).
+    A transaction is expired once the chain passes its expiration index.
+    """
+    def __init__(self, max_size=MAX_MEMPOOL_SIZE):
+        self.max_size = max_size
+        self.by_hash = OrderedDict()  # hash -> Transaction, in arrival order
+        self.by_sender = {}  # sender public key -> set of hashes
+        self.pending_amount = {}  # sender public key -> sum of the amounts of its transactions
+        self.expirations = []  # heap of (expiration, seq, hash), removed transactions are skipped lazily
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __contains__(self, tx_hash: bytes):
+        return tx_hash in self.by_hash
+
+    def add(self, transaction: Transaction) -> bool:
+        """Adds the transaction, returns False if it is known, conflicting or the pool is full."""
+        tx_hash = transaction.compute_hash()
+        sender = transaction.sender_balance.public_key
+        with self.lock:
+            if tx_hash in self.by_hash or len(self.by_hash) >= self.max_size:
+                return False
+            # The sender's pending transactions together can't spend more than the balance it proved.
+            if self.pending_amount.get(sender, 0) + transaction.amount > transaction.sender_balance.money:
+                return False
+            self.by_hash[tx_hash] = transaction
+            self.by_sender.setdefault(sender, set()).add(tx_hash)
+            self.pending_amount[sender] = self.pending_amount.get(sender, 0) + transaction.amount
+            heapq.heappush(self.expirations, (transaction.expiration, next(self.seq), tx_hash))
+            return True
+
+    def _remove(self, tx_hash: bytes):
+        transaction = self.by_hash.pop(tx_hash, None)
+        if transaction is None:
+            return
+        sender = transaction.sender_balance.public_key
+        hashes = self.by_sender[sender]
+        hashes.discard(tx_hash)
+        self.pending_amount[sender] -= transaction.amount
+        if not hashes:
+            del self.by_sender[sender]
+            del self.pending_amount[sender]
+
+    def remove(self, transactions):
+        """Removes the given transactions (e.g. because they were put in a block)."""
+        with self.lock:
+            for transaction in transactions:
+                self._remove(transaction.compute_hash())
+            if len(self.expirations) > 2 * len(self.by_hash) + 1024:
+                self.expirations = [e for e in self.expirations if e[2] in self.by_hash]
+                heapq.heapify(self.expirations)
+
+    def prune_expired(self, curr_index: int) -> int:
+        """Removes the transactions that can no longer be put in a block, returns how many were removed."""
+        removed = 0
+        with self.lock:
+            while self.expirations and self.expirations[0][0] < curr_index:
+                _, _, tx_hash = heapq.heappop(self.expirations)
+                if tx_hash in self.by_hash:
+                    self._remove(tx_hash)
+                    removed += 1
+        return removed
+
+    def select(self, count: int, block_index: int):
+        """The next `count` transactions that can go in a block with the given index."""
+        result = []
+        with self.lock:
+            for transaction in self.by_hash.values():
+                if len(result) == count:
+                    break
+                if transaction.expiration >= block_index:
+                    result.append(transaction)
+        return result
+
+    def by_sender_key(self, public_key: str):
+        with self.lock:
+            return [self.by_hash[h] for h in self.by_sender.get(public_key, ())]
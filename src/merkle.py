@@ -0,0 +1,71 @@
+import hashlib
+
+# Leaves and inner nodes are hashed with different prefixes so a leaf can't pose as an inner node.
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+EMPTY_ROOT = hashlib.sha256(b"").digest()
+
+
+def leaf_hash(item: bytes) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + item).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree:
+    """
+    Binary Merkle tree over transaction hashes that supports appending in O(log n).
+    A node without a right sibling is moved up a level as is.
+    """
+    def __init__(self, items=None):
+        self.levels = [[]]  # levels[0] are the leaf hashes, levels[-1] holds the root
+        for item in items or []:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self, item: bytes):
+        self.levels[0].append(leaf_hash(item))
+        idx = len(self.levels[0]) - 1
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            parent_idx = idx // 2
+            left = nodes[2 * parent_idx]
+            parent = node_hash(left, nodes[2 * parent_idx + 1]) if 2 * parent_idx + 1 < len(nodes) else left
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            if parent_idx < len(parents):
+                parents[parent_idx] = parent
+            else:
+                parents.append(parent)
+            idx = parent_idx
+            level += 1
+
+    def root(self) -> bytes:
+        if not self.levels[0]:
+            return EMPTY_ROOT
+        return self.levels[-1][0]
+
+    def proof(self, idx: int):
+        """Inclusion proof of the idx-th item: list of (sibling hash, sibling is on the left)."""
+        if not 0 <= idx < len(self):
+            raise IndexError(f"No item {idx} in a tree of {len(self)} items")
+        result = []
+        for nodes in self.levels[:-1]:
+            sibling = idx ^ 1
+            if sibling < len(nodes):
+                result.append((nodes[sibling], sibling < idx))
+            idx //= 2
+        return result
+
+    @staticmethod
+    def verify_proof(item: bytes, proof, root: bytes) -> bool:
+        h = leaf_hash(item)
+        for sibling, sibling_is_left in proof:
+            h = node_hash(sibling, h) if sibling_is_left else node_hash(h, sibling)
+        return h == root
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+MAX_ORPHANS = 1024  # Blocks parked at once, see OrphanPool.add for what happens beyond this
+
+
+class OrphanPool:
+    """
+    Blocks whose parent we don't have yet, kept until their ancestors are fetched.
+    Each orphan is (block, block request), the request is None for ancestors fetched by hash.
+    """
+    def __init__(self, max_size=MAX_ORPHANS):
+        self.max_size = max_size
+        self.by_hash = OrderedDict()  # hash -> (block, block request), in arrival order
+        self.by_parent = {}  # parent hash -> set of hashes
+        self.fetching = set()  # hashes whose ancestors are being requested
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.by_hash
+
+    def is_full(self) -> bool:
+        return len(self.by_hash) >= self.max_size
+
+    def add(self, block, block_req=None) -> bool:
+        """
+        Parks the block, returns False if it is already parked or the pool is full and it is an ancestor.
+        A full pool drops its oldest block for a new block request, but not for ancestors, since those are
+        fetched on behalf of the parked blocks and would push out the very blocks they were fetched for.
+        """
+        with self.lock:
+            if block.hash in self.by_hash:
+                return False
+            if len(self.by_hash) >= self.max_size:
+                if block_req is None:
+                    return False
+                self._remove(next(iter(self.by_hash)))
+            self.by_hash[block.hash] = (block, block_req)
+            self.by_parent.setdefault(block.prev_hash, set()).add(block.hash)
+            return True
+
+    def _remove(self, block_hash):
+        block, _ = self.by_hash.pop(block_hash)
+        children = self.by_parent[block.prev_hash]
+        children.discard(block_hash)
+        if not children:
+            del self.by_parent[block.prev_hash]
+
+    def pop_connectable(self, is_known):
+        """Removes and returns the orphans whose parent is_known(parent hash)."""
+        with self.lock:
+            parents = [parent for parent in self.by_parent if is_known(parent)]
+            hashes = [h for parent in parents for h in self.by_parent[parent]]
+            orphans = [self.by_hash[h] for h in hashes]
+            for h in hashes:
+                self._remove(h)
+        return orphans
+
+    def start_fetch(self, block_hash) -> bool:
+        """Returns False if the block and its ancestors are already being requested."""
+        with self.lock:
+            if block_hash in self.fetching:
+                return False
+            self.fetching.add(block_hash)
+            return True
+
+    def end_fetch(self, block_hash):
+        with self.lock:
+            self.fetching.discard(block_hash)
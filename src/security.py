@@ -2,7 +2,16 @@ from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.backends import default_backend
 from cryptography.exceptions import InvalidSignature
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import base64
+import os
+from utils import LRUCache
+
+# RSA verification in cryptography releases the GIL, so a thread pool scales with cores.
+VERIFY_WORKERS = os.cpu_count() or 1
+PARALLEL_VERIFY_MIN = 16  # Smaller batches are verified on the calling thread
+KEY_CACHE_SIZE = 4096  # Distinct accounts whose parsed/decoded public keys are kept
 
 # Generate private key
 private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
@@ -59,9 +68,55 @@ def sign(data: bytes) -> bytes:
     )
 
 
-def verify_signed(data: bytes, signature: bytes, user_public_key_str: bytes) -> bool:
-    # Deserialize public key
-    pubkey = serialization.load_der_public_key(base64.b64decode(user_public_key_str))
+_verify_pool = None
+_verify_pool_lock = threading.Lock()
+
+
+def get_verify_pool():
+    global _verify_pool
+    with _verify_pool_lock:
+        if _verify_pool is None:
+            _verify_pool = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+        return _verify_pool
+
+
+# Both keyed by the base64 public key string as it appears in BalanceInfo.
+_decoded_key_cache = LRUCache(KEY_CACHE_SIZE)
+_parsed_key_cache = LRUCache(KEY_CACHE_SIZE)
+
+
+def _decode_public_key(user_public_key_str):
+    if isinstance(user_public_key_str, str):
+        user_public_key_str = user_public_key_str.encode("ascii")
+    return base64.b64decode(user_public_key_str)
+
+
+def decode_public_key(user_public_key_str) -> bytes:
+    """Raw bytes of a base64 encoded public key."""
+    return _decoded_key_cache.get_or_compute(user_public_key_str, _decode_public_key)
+
+
+def _parse_public_key(user_public_key_str):
+    key_bytes = decode_public_key(user_public_key_str)
+    if key_bytes.startswith(b"-----BEGIN"):
+        return serialization.load_pem_public_key(key_bytes)
+    return serialization.load_der_public_key(key_bytes)
+
+
+def load_public_key(user_public_key_str):
+    """Parses a base64 encoded public key, in PEM (as get_public_key_str returns) or DER form."""
+    return _parsed_key_cache.get_or_compute(user_public_key_str, _parse_public_key)
+
+
+def key_cache_stats():
+    return {"decoded": _decoded_key_cache.stats(), "parsed": _parsed_key_cache.stats()}
+
+
+def verify_signed(data: bytes, signature: bytes, user_public_key_str) -> bool:
+    return verify_with_key(load_public_key(user_public_key_str), data, signature)
+
+
+def verify_with_key(pubkey, data: bytes, signature: bytes) -> bool:
     try:
         pubkey.verify(
             signature,
@@ -75,3 +130,43 @@ def verify_signed(data: bytes, signature: bytes, user_public_key_str: bytes) ->
         return True  # Signature is valid
     except InvalidSignature:
         return False  # Signature is invalid
+
+
+def verify_many(items) -> bool:
+    """
+    Verifies a batch of (data, signature, user_public_key_str) items, returns True only if all are valid.
+    Every distinct key is parsed once, and the batch stops at the first invalid signature.
+    """
+    items = list(items)
+    keys = {}
+    try:
+        for _, _, key_str in items:
+            if key_str not in keys:
+                keys[key_str] = load_public_key(key_str)
+    except ValueError:
+        return False
+
+    if len(items) < PARALLEL_VERIFY_MIN or VERIFY_WORKERS == 1:
+        return all(verify_with_key(keys[key_str], data, signature) for data, signature, key_str in items)
+
+    failed = threading.Event()
+
+    def verify_chunk(chunk):
+        for data, signature, key_str in chunk:
+            if failed.is_set():
+                return False
+            if not verify_with_key(keys[key_str], data, signature):
+                failed.set()
+                return False
+        return True
+
+    chunk_size = -(-len(items) // VERIFY_WORKERS)
+    pool = get_verify_pool()
+    futures = [pool.submit(verify_chunk, items[i:i + chunk_size]) for i in range(0, len(items), chunk_size)]
+    for future in as_completed(futures):
+        if not future.result():
+            failed.set()
+            for f in futures:
+                f.cancel()
+            return False
+    return True
@@ -0,0 +1,151 @@
+import os
+from blockchain import bytes_to_string, string_to_bytes, check, decode, is_u64, is_i64, is_hash, is_bytes_list
+from codec import Writer, Reader, write_header, read_header
+from bin_heap import virt_bin_heap
+
+KIND_SNAPSHOT = 7  # Next to the object kinds of blockchain.py
+SNAPSHOT_FILE = "snapshot.dat"
+DIGEST_SIZE = 32  # Every node of the heap is a sha256 digest
+
+
+class Snapshot:
+    """
+    State of the money heap as of a main chain block: its leaf count and roots, and optionally our own
+    leaf (pos, money, brolist). Snapshots sent to peers leave our own leaf out.
+    Roots are stored as raw digests, legacy (hex) heaps get them back as hex.
+    """
+    def __init__(self, block_hash, height, n, roots, binary, pos=None, money=None, brolist=None):
+        self.block_hash = block_hash
+        self.height = height
+        self.n = n
+        self.roots = roots
+        self.binary = binary
+        self.pos = pos
+        self.money = money
+        self.brolist = brolist
+
+    @staticmethod
+    def of(heap: virt_bin_heap, block, include_own=True):
+        own = include_own and heap.created
+        return Snapshot(block.hash, block.index, heap.n, heap.roots_bytes(), heap.binary,
+                        heap.pos if own else None, heap.money if own else None,
+                        [virt_bin_heap.to_digest(b) for b in heap.brolist] if own else None)
+
+    def to_heap(self) -> virt_bin_heap:
+        convert = (lambda h: h) if self.binary else virt_bin_heap.to_hex
+        heap = virt_bin_heap(self.n, [convert(r) for r in self.roots], binary=self.binary)
+        if self.pos is not None:
+            heap.create([convert(b) for b in self.brolist], self.money, self.pos)
+        return heap
+
+    def root_level(self, pos):
+        """Level of the root whose tree holds the position, which is also the length of its brolist."""
+        start = 0
+        for level in reversed(range(self.n.bit_length())):
+            if self.n & (1 << level):
+                start += 1 << level
+                if pos < start:
+                    return level
+        return None
+
+    def validate(self):
+        check(is_hash(self.block_hash), "Snapshot block_hash must be a hash of at most 32 bytes")
+        check(is_u64(self.height), f"Invalid Snapshot height {self.height!r}")
+        check(is_u64(self.n), f"Invalid Snapshot n {self.n!r}")
+        check(is_bytes_list(self.roots, DIGEST_SIZE) and all(len(r) == DIGEST_SIZE for r in self.roots),
+              "Snapshot roots must be a list of 32 byte digests")
+        # The heap has a perfect tree (so a root) for every bit set in n.
+        check(len(self.roots) == bin(self.n).count("1"), f"Snapshot of {self.n} leaves can't have {len(self.roots)} roots")
+        check(isinstance(self.binary, bool), "Snapshot binary must be a bool")
+        if self.pos is None:
+            check(self.money is None and self.brolist is None, "Snapshot money and brolist need a pos")
+            return
+        check(is_u64(self.pos) and self.pos < self.n, f"Invalid Snapshot pos {self.pos!r}")
+        check(is_i64(self.money, 0), f"Invalid Snapshot money {self.money!r}")
+        check(is_bytes_list(self.brolist, DIGEST_SIZE) and all(len(b) == DIGEST_SIZE for b in self.brolist),
+              "Snapshot brolist must be a list of 32 byte digests")
+        check(len(self.brolist) == self.root_level(self.pos), f"Snapshot brolist doesn't lead from {self.pos} to a root")
+
+    def to_dict(self):
+        return {
+            "block_hash": bytes_to_string(self.block_hash),
+            "height": self.height,
+            "n": self.n,
+            "roots": [bytes_to_string(r) for r in self.roots],
+            "binary": self.binary,
+            "pos": self.pos,
+            "money": self.money,
+            "brolist": None if self.brolist is None else [bytes_to_string(b) for b in self.brolist]
+        }
+
+    @staticmethod
+    def read_dict(data, trusted=False):
+        return Snapshot(
+            block_hash=string_to_bytes(data["block_hash"]),
+            height=data["height"],
+            n=data["n"],
+            roots=[string_to_bytes(r) for r in data["roots"]],
+            binary=data["binary"],
+            pos=data["pos"],
+            money=data["money"],
+            brolist=None if data["brolist"] is None else [string_to_bytes(b) for b in data["brolist"]]
+        )
+
+    @staticmethod
+    def from_dict(data, trusted=False):
+        return decode(Snapshot.read_dict, data, trusted)
+
+    def to_bytes(self) -> bytes:
+        w = Writer()
+        write_header(w, KIND_SNAPSHOT)
+        w.short_bytes(self.block_hash)
+        w.u64(self.height)
+        w.u64(self.n)
+        w.u32(len(self.roots))
+        for r in self.roots:
+            w.short_bytes(r)
+        w.u8(1 if self.binary else 0)
+        w.u8(0 if self.pos is None else 1)
+        if self.pos is not None:
+            w.u64(self.pos)
+            w.i64(self.money)
+            w.u32(len(self.brolist))
+            for b in self.brolist:
+                w.short_bytes(b)
+        return w.getvalue()
+
+    @staticmethod
+    def read_from(r: Reader, trusted=False):
+        block_hash = r.short_bytes()
+        height = r.u64()
+        n = r.u64()
+        roots = [r.short_bytes() for _ in range(r.u32())]
+        binary = r.u8() == 1
+        if r.u8() == 0:
+            return Snapshot(block_hash, height, n, roots, binary)
+        pos = r.u64()
+        money = r.i64()
+        brolist = [r.short_bytes() for _ in range(r.u32())]
+        return Snapshot(block_hash, height, n, roots, binary, pos, money, brolist)
+
+    @staticmethod
+    def from_bytes(data: bytes, trusted=False):
+        r = Reader(data)
+        read_header(r, KIND_SNAPSHOT)
+        return decode(Snapshot.read_from, r, trusted)
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """The snapshot saved at path, or None if there is none."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return Snapshot.from_bytes(f.read(), trusted=True)
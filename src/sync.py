@@ -0,0 +1,165 @@
+import logging
+from blockchain import bytes_to_string
+from gossip import MAX_HEADERS_PER_REQUEST
+
+log = logging.getLogger(__name__)
+
+BODIES_PER_REQUEST = 100  # Blocks asked for in one get_blocks request
+BODY_REQUESTS_IN_FLIGHT = 16  # Body requests sent at once, spread over the peers
+SYNC_TIMEOUT = 30
+
+
+class HeaderSync:
+    """
+    Headers-first sync: every peer is asked for the headers of its chain after ours, the chains are
+    checked to link up and compared by stake on headers alone, and then the bodies of the best chain are
+    fetched in parallel from all peers, in windows so only a window of blocks is held at once.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.gossip = user.gossip
+
+    def locator(self):
+        """Hashes of our main chain, every block near the tip and then exponentially sparser back to genesis."""
+        store = self.user.block_store
+        hashes = []
+        height = store.tip_height()
+        step = 1
+        while height > 0:
+            hashes.append(store.hash_at(height))
+            if len(hashes) >= 10:
+                step *= 2
+            height -= step
+        hashes.append(store.hash_at(0))
+        return [h for h in hashes if h is not None]
+
+    def peer_chain(self, peer):
+        """The headers the peer has after its last block on our main chain, or [] if they don't link up."""
+        tree = self.user.block_tree
+        headers = []
+        locator = self.locator()
+        while True:
+            try:
+                data = self.gossip.request_peer(peer, "get_headers", {
+                    "locator": [bytes_to_string(h) for h in locator], "count": MAX_HEADERS_PER_REQUEST
+                }).result(SYNC_TIMEOUT)
+            except Exception as e:
+                log.warning("Error getting headers from %s - %s", peer, e)
+                break
+            try:
+                batch = self.gossip.decode_headers(data) if data else []
+            except Exception as e:
+                log.warning("Bad headers from %s - %s", peer, e)
+                return []
+            if not batch:
+                break
+            if headers:
+                prev_hash, prev_index = headers[-1].hash, headers[-1].index
+            elif batch[0].prev_hash in tree:
+                prev_hash, prev_index = batch[0].prev_hash, tree.height(batch[0].prev_hash)
+            else:
+                log.info("Chain of %s forks off below block %s, not following it", peer, tree.root_height())
+                return []
+            for header in batch:
+                if header.prev_hash != prev_hash or header.index != prev_index + 1:
+                    log.warning("Headers from %s don't link up", peer)
+                    return []
+                prev_hash, prev_index = header.hash, header.index
+            headers.extend(batch)
+            if len(batch) < MAX_HEADERS_PER_REQUEST:
+                break
+            locator = [headers[-1].hash]
+        return headers
+
+    def chain_stake(self, headers):
+        return self.user.block_tree.stake(headers[0].prev_hash) + sum(h.stake for h in headers)
+
+    def fetch_bodies(self, headers, peers):
+        """Blocks of the headers, fetched in parallel. Stops at the first block no peer gave us."""
+        batches = [headers[i:i + BODIES_PER_REQUEST] for i in range(0, len(headers), BODIES_PER_REQUEST)]
+        results = [None] * len(batches)
+        for attempt in range(len(peers)):  # A batch that failed is asked from the next peer
+            pending = {}
+            for i, batch in enumerate(batches):
+                if results[i] is None:
+                    pending[i] = self.gossip.request_peer(peers[(i + attempt) % len(peers)], "get_blocks", {
+                        "hash": bytes_to_string(batch[-1].hash), "count": len(batch)
+                    }, timeout=SYNC_TIMEOUT)
+            for i, future in pending.items():
+                try:
+                    data = future.result()
+                    blocks = self.gossip.decode_blocks(data) if data else []
+                except Exception as e:
+                    log.warning("Error getting blocks - %s", e)
+                    continue
+                if len(blocks) == len(batches[i]) and all(h.matches(b) for h, b in zip(batches[i], blocks)) and \
+                        all(self.user.validator.body_ok(b) for b in blocks):
+                    results[i] = blocks
+            if all(r is not None for r in results):
+                break
+        blocks = []
+        for result in results:
+            if result is None:
+                break
+            blocks.extend(result)
+        return blocks
+
+    def run(self) -> int:
+        peers = list(self.gossip.peers)
+        if not peers:
+            return 0
+        futures = [(peer, self.gossip.transport.submit(self.peer_chain, peer)) for peer in peers]
+        chains = [(peer, chain) for peer, chain in ((peer, f.result()) for peer, f in futures) if chain]
+        # The stake of a header is only what the peer claims until its body is fetched (see BlockHeader.matches),
+        # so a chain whose bodies don't match is dropped with its peer and the next best one is tried.
+        chains.sort(key=lambda c: self.chain_stake(c[1]), reverse=True)
+        for peer, chain in chains:
+            if self.chain_stake(chain) <= self.user.block_tree.stake(self.user.last_hash):
+                break
+            added = self.follow(chain, peers)
+            if added is not None:
+                return added
+            log.warning("Blocks of the chain of %s don't match its headers, trying the next best chain", peer)
+            peers.remove(peer)
+            if not peers:
+                break
+        return 0
+
+    def follow(self, best, peers):
+        """
+        Fetches the blocks of the chain and switches to it. Returns how many blocks were added, or None if
+        not even the first window of blocks could be fetched (nothing changed then).
+        """
+        # Blocks that extend our tip are added as they arrive, a competing branch only once it is all here.
+        extends_tip = best[0].prev_hash == self.user.last_hash
+        branch = []
+        added = 0
+        window = BODIES_PER_REQUEST * BODY_REQUESTS_IN_FLIGHT
+        for start in range(0, len(best), window):
+            headers = best[start:start + window]
+            blocks = self.fetch_bodies(headers, peers)
+            if start == 0 and not blocks:
+                return None
+            if extends_tip:
+                with self.user.chain_lock:
+                    for block in blocks:
+                        if block.prev_hash != self.user.last_hash:
+                            log.info("Tip moved while syncing, stopping")
+                            return added
+                        self.user.add_block(block)
+                        self.user.last_hash = block.hash
+                        added += 1
+            else:
+                branch.extend(blocks)
+            if len(blocks) < len(headers):
+                break
+        if not extends_tip and branch:
+            with self.user.chain_lock:
+                for block in branch:
+                    if not self.user.add_side_block(block):
+                        return 0
+            # reorg takes the chain lock itself, once it has every block of the branch.
+            if self.user.block_tree.stake(branch[-1].hash) > self.user.block_tree.stake(self.user.last_hash) and \
+                    self.user.reorg(branch[-1].hash):
+                added = len(branch)
+        return added
@@ -0,0 +1,82 @@
+import random
+from fork_choice import BlockTree
+
+
+class FakeBlock:
+    def __init__(self, block_hash, prev_hash, index, stake=1):
+        self.hash = block_hash
+        self.prev_hash = prev_hash
+        self.index = index
+        self.stake = stake
+
+
+def random_tree(size, seed=0):
+    rng = random.Random(seed)
+    tree = BlockTree()
+    parents = {0: None}
+    heights = {0: 0}
+    tree.add(FakeBlock(0, None, 0))
+    for h in range(1, size):
+        parent = rng.randrange(h)
+        parents[h] = parent
+        heights[h] = heights[parent] + 1
+        assert tree.add(FakeBlock(h, parent, heights[h]))
+    return tree, parents, heights
+
+
+def naive_common_ancestor(parents, heights, a, b):
+    while heights[a] > heights[b]:
+        a = parents[a]
+    while heights[b] > heights[a]:
+        b = parents[b]
+    while a != b:
+        a, b = parents[a], parents[b]
+    return a
+
+
+def test_common_ancestor_matches_naive_walk():
+    tree, parents, heights = random_tree(400)
+    rng = random.Random(1)
+    for _ in range(2000):
+        a, b = rng.randrange(400), rng.randrange(400)
+        assert tree.common_ancestor(a, b) == naive_common_ancestor(parents, heights, a, b)
+
+
+def test_common_ancestor_of_branches_split_at_root():
+    tree = BlockTree()
+    tree.add(FakeBlock("root", None, 0))
+    for branch in "ab":
+        prev = "root"
+        for i in range(1, 6):
+            tree.add(FakeBlock(f"{branch}{i}", prev, i))
+            prev = f"{branch}{i}"
+    assert tree.common_ancestor("a5", "b5") == "root"
+
+
+def test_ancestor_and_path_match_naive_walk():
+    tree, parents, heights = random_tree(400, seed=2)
+    for h in range(400):
+        node, expected = h, []
+        while node != 0:
+            expected.append(node)
+            node = parents[node]
+        assert tree.path(0, h) == expected[::-1]
+        for height in range(heights[h] + 1):
+            assert heights[tree.ancestor(h, height)] == height
+
+
+def test_add_refuses_index_not_after_parent():
+    tree = BlockTree()
+    tree.add(FakeBlock("root", None, 5))
+    assert not tree.add(FakeBlock("a", "root", 7))
+    assert "a" not in tree
+    assert tree.add(FakeBlock("a", "root", 6))
+    assert tree.height("a") == 6
+
+
+def test_root_height_is_first_block():
+    tree = BlockTree()
+    assert tree.root_height() is None
+    tree.add(FakeBlock("root", None, 5))
+    tree.add(FakeBlock("a", "root", 6))
+    assert tree.root_height() == 5
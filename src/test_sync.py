@@ -0,0 +1,62 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import blockchain__impl
+from blockchain__impl import BlockchainUser
+from bin_heap import virt_bin_heap
+from gossip import GossipNode
+from inventory import Inventory
+
+
+class LoopbackTransport:
+    """Hands every request straight to the handle_message of the node it is addressed to."""
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.handlers = ThreadPoolExecutor(max_workers=4)
+
+    def request(self, addr, payload, timeout=None):
+        future = Future()
+        future.set_result(self.nodes[addr].handle_message(payload, "127.0.0.1"))
+        return future
+
+    def send(self, addr, payload):
+        pass
+
+    def submit(self, func, *args):
+        return self.handlers.submit(func, *args)
+
+
+def make_node(monkeypatch, tmp_path, name, nodes):
+    monkeypatch.setattr(blockchain__impl, "GossipNode", lambda *args: None)
+    monkeypatch.setattr(blockchain__impl, "do_periodic", lambda *args: None)
+    user = BlockchainUser(0, name, data_dir=str(tmp_path / name))
+    gossip = GossipNode.__new__(GossipNode)
+    gossip.user = user
+    gossip.port = 0
+    gossip.binary = True
+    gossip.inventory = Inventory()
+    gossip.peers = []
+    gossip.transport = LoopbackTransport(nodes)
+    user.gossip = gossip
+    nodes[name] = gossip
+    return user
+
+
+def produce(user, count):
+    """Commits `count` blocks made by create_blockrequest, each winning its own interval."""
+    user.money_heap = virt_bin_heap(1, [b"\x00" * 32], binary=True)
+    user.money_heap.create([], 5, 0)
+    for interval in range(1000, 1000 + count):
+        block_req = user.create_blockrequest(user.interval_time(interval), user.interval_time(interval + 1))
+        user.finalize_interval(interval)
+        assert user.last_hash == block_req.block.hash
+
+
+def test_sync_fetches_a_produced_chain(monkeypatch, tmp_path):
+    nodes = {}
+    producer = make_node(monkeypatch, tmp_path, "a", nodes)
+    joiner = make_node(monkeypatch, tmp_path, "b", nodes)
+    produce(producer, 5)
+    joiner.gossip.peers = ["a"]
+    joiner.money_heap = virt_bin_heap(1, [b"\x00" * 32], binary=True)  # So sync doesn't ask for a snapshot
+    assert joiner.sync() == 5
+    assert joiner.last_hash == producer.last_hash
+    assert joiner.block_store.tip_height() == 5
@@ -0,0 +1,82 @@
+import heapq
+import threading
+
+MAX_REQUESTS_PER_INTERVAL = 1024  # Requests kept per interval, a worse one is refused once it is full
+
+
+class IntervalTournament:
+    """
+    Competing block requests, bucketed by the interval of their ticket. Each bucket is a min-heap by
+    ticket value, so the best request of an interval is at the top and adding one is O(log n).
+    An interval is finalized once, after its deadline, and requests for it are refused from then on.
+    A full bucket only takes a request better than its worst, which is dropped.
+    """
+    def __init__(self, max_per_interval=MAX_REQUESTS_PER_INTERVAL):
+        self.max_per_interval = max_per_interval
+        self.buckets = {}  # interval -> heap of (ticket, request hash, block request)
+        self.hashes = {}  # interval -> set of request hashes in the bucket
+        self.finalized = None  # Intervals up to this one are closed
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def is_closed(self, interval) -> bool:
+        return self.finalized is not None and interval <= self.finalized
+
+    def add(self, interval, block_req) -> bool:
+        """
+        Enters the request, returns False if its interval is closed, it was already entered or the interval is
+        full of better requests.
+        """
+        with self.lock:
+            if self.is_closed(interval):
+                return False
+            hashes = self.hashes.setdefault(interval, set())
+            if block_req.hash in hashes:
+                return False
+            # The request hash breaks ties, so requests themselves are never compared.
+            entry = (block_req.heart.int_hash(), block_req.hash, block_req)
+            bucket = self.buckets.setdefault(interval, [])
+            if len(bucket) >= self.max_per_interval:
+                worst = max(bucket, key=lambda e: e[:2])
+                if entry[:2] >= worst[:2]:
+                    return False
+                bucket.remove(worst)
+                heapq.heapify(bucket)
+                hashes.discard(worst[1])
+            hashes.add(block_req.hash)
+            heapq.heappush(bucket, entry)
+            return True
+
+    def best(self, interval):
+        with self.lock:
+            bucket = self.buckets.get(interval)
+            return bucket[0][2] if bucket else None
+
+    def may_win(self, interval, block_req) -> bool:
+        """False if the request can't win its interval: it is closed or has a better request on the same parent."""
+        with self.lock:
+            if self.is_closed(interval):
+                return False
+            bucket = self.buckets.get(interval)
+            if not bucket:
+                return True
+            ticket, _, best = bucket[0]
+            return best.block.prev_hash != block_req.block.prev_hash or block_req.heart.int_hash() < ticket
+
+    def finalize(self, interval):
+        """
+        Closes every interval up to the given one and returns [(interval, requests best first)] for the
+        intervals that had requests, oldest interval first.
+        """
+        with self.lock:
+            if self.finalized is None or interval > self.finalized:
+                self.finalized = interval
+            closed = sorted(i for i in self.buckets if i <= interval)
+            result = []
+            for i in closed:
+                bucket = self.buckets.pop(i)
+                del self.hashes[i]
+                result.append((i, [heapq.heappop(bucket)[2] for _ in range(len(bucket))]))
+            return result
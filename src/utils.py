@@ -1,13 +1,72 @@
+import logging
 import time
 import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
 
 
 def do_periodic(func, args, period_seconds):
     def loop():
         while True:
             if func(*args):
-                print("Already valid! exiting...")
+                log.info("Already valid! exiting...")
                 return
             time.sleep(period_seconds)
     thread = threading.Thread(target=loop, daemon=True)
     thread.start()
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread safe bounded mapping that evicts the least recently used entry, counts hits and misses."""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute(key)
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {"size": len(self.items), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
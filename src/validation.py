@@ -0,0 +1,80 @@
+from blockchain import BlockRequest
+from security import verify_many
+from utils import LRUCache
+
+VALIDATION_CACHE_SIZE = 4096  # Block requests whose validation result is remembered
+
+
+class BlockValidator:
+    """
+    Validates block requests in stages, cheapest first, and stops at the first failing one:
+    header (linkage to the parent), lottery ticket, proof of work, then the transactions.
+    So junk and losing requests are rejected before a single signature is verified.
+    Results are cached by request hash and roots epoch, so a request delivered by several peers is only
+    validated once.
+    """
+    def __init__(self, user, cache_size=VALIDATION_CACHE_SIZE):
+        self.user = user
+        self.results = LRUCache(cache_size)
+
+    def validate(self, block_request: BlockRequest) -> bool:
+        # Balance proofs depend on the roots, so a result only holds for the epoch it was computed in.
+        key = (block_request.hash, self.user.money_heap.epoch)
+        result = self.results.get(key)
+        if result is None:
+            result = self.header_ok(block_request) and self.ticket_ok(block_request) and \
+                     self.pow_ok(block_request) and self.transactions_ok(block_request)
+            self.results.put(key, result)
+        return result
+
+    def header_ok(self, block_request: BlockRequest) -> bool:
+        # TODO: Maybe check timestamp.
+        block = block_request.block
+        if block.index == 0:
+            return True
+        tree = self.user.block_tree
+        if block.prev_hash in tree:
+            return block.index == tree.height(block.prev_hash) + 1
+        parent = self.user.get_block(block.prev_hash)
+        return parent is not None and block.index == parent.index + 1
+
+    def ticket_ok(self, block_request: BlockRequest) -> bool:
+        block = block_request.block
+        return block_request.heart.int_hash() < block.balance_info.money * self.user.calc_difficulty_factor()
+
+    def pow_ok(self, block_request: BlockRequest) -> bool:
+        return self.block_pow_ok(block_request.block)
+
+    def block_pow_ok(self, block) -> bool:
+        return self.user.pow_correct(block) and any(self.user.is_pow_transaction(block, t) for t in block.transactions)
+
+    @staticmethod
+    def expired(block) -> bool:
+        return any(t.expiration < block.index for t in block.transactions)
+
+    def body_ok(self, block) -> bool:
+        """
+        The checks that don't depend on the money heap, for block bodies fetched by sync (whose balance proofs
+        are against roots we don't have): expiration, proof of work and signatures.
+        Blocks are made without proof of work until it is found (pow_key is None then, see
+        BlockchainUser.create_blockrequest), so only a block that names a proof of work key has it checked.
+        """
+        return not self.expired(block) and (block.pow_key is None or self.block_pow_ok(block)) and \
+            verify_many(t.signature_item() for t in block.transactions)
+
+    def transactions_ok(self, block_request: BlockRequest) -> bool:
+        block = block_request.block
+        if self.expired(block):
+            return False
+        # Transactions we already validated (most of them come from our mempool) are not checked again.
+        epoch = self.user.money_heap.epoch
+        unseen = [t for t in block.transactions if not self.user.is_verified(t, epoch)]
+        # Balance proofs are a few hashes (cached), so they go before the signatures, which are verified
+        # in one batch spread over the verify pool (see security.verify_many).
+        if not all(self.user.validate_transaction(t, check_signature=False) for t in unseen):
+            return False
+        if not verify_many(t.signature_item() for t in unseen):
+            return False
+        for t in unseen:
+            self.user.set_verified(t, epoch)
+        return True